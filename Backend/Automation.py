@@ -10,6 +10,7 @@ from docx import Document
 from docx.shared import Pt, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import re
+from keyword_router import KeywordRouter
 import google.generativeai as genai # <<< THÊM: Import Gemini
 import webbrowser
 import subprocess
@@ -290,9 +291,15 @@ def CloseApp(app):
         print(f"❌ Lỗi CloseApp: {e}")
         return False
 
-# --- D. Công cụ Điều khiển Hệ thống (Giữ nguyên) ---
+# --- D. Công cụ Điều khiển Hệ thống ---
+SYSTEM_ROUTER = KeywordRouter({
+    "mute": ["mute", "tắt tiếng"],
+    "unmute": ["unmute", "bật tiếng"],
+    "volume_up": ["volume up", "tăng âm lượng"],
+    "volume_down": ["volume down", "giảm âm lượng"],
+})
+
 def System(command):
-    # (Code hàm này giữ nguyên)
     def mute():
         keyboard.press_and_release("volume mute")
     def unmute():
@@ -301,19 +308,14 @@ def System(command):
         keyboard.press_and_release("volume up")
     def volume_down():
         keyboard.press_and_release("volume down")
+    actions = {"mute": mute, "unmute": unmute, "volume_up": volume_up, "volume_down": volume_down}
     try:
         cmd = command.lower().strip()
-        if cmd == "mute" or "tắt tiếng" in cmd:
-            mute()
-        elif cmd == "unmute" or "bật tiếng" in cmd:
-            unmute()
-        elif "volume up" in cmd or "tăng âm lượng" in cmd:
-            volume_up()
-        elif "volume down" in cmd or "giảm âm lượng" in cmd:
-            volume_down()
-        else:
+        action = SYSTEM_ROUTER.best(cmd)
+        if action is None:
             print(f"⚠️ Không hiểu lệnh hệ thống: {cmd}")
             return False
+        actions[action]()
         return True
     except Exception as e:
         print(f"❌ Lỗi System: {e}")
@@ -4,14 +4,21 @@
 # ==========================================
 
 import os
-from datetime import datetime
+import time
+import threading
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta, timezone
 from groq import Groq
 from dotenv import load_dotenv
-from RealtimeTools import LayThongTinThoiGianThuc, LayThongTinThoiTiet
+from RealtimeTools import LayThongTinThoiGianThuc, LayThongTinThoiTiet, LayThongTinThoiTietDaCache
 
 # --- 1. KẾT NỐI DATABASE ---
 from db_connect import db 
 from firebase_admin import firestore
+from db_writer import write_behind
+from db_cache import get_user_doc
+from keyword_router import KeywordRouter
+from metrics import timed, observe_stage, stage_errors
 
 # === 2. Load cấu hình ===
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -21,6 +28,7 @@ load_dotenv(env_path)
 
 # 👇 Đã XÓA dòng ten_nguoi_dung = os.getenv... vì không cần nữa
 ten_tro_ly = os.getenv("Assistantname", "Vist")
+CHAT_MODEL = "llama-3.3-70b-versatile"
 GroqAPIKey2 = os.getenv("GroqAPIKey2")
 
 if not GroqAPIKey2:
@@ -41,85 +49,346 @@ def lay_ten_nguoi_dung(user_id):
     """Vào Firestore lấy tên thật của user, nếu không thấy thì gọi là 'Bạn'"""
     try:
         if user_id:
-            # Vào collection 'users', tìm document có id là user_id
-            doc = db.collection('users').document(user_id).get()
-            if doc.exists:
-                data = doc.to_dict()
+            # Đọc users/{user_id} qua cache dùng chung (db_cache)
+            data = get_user_doc(user_id)
+            if data:
                 # Lấy trường 'name' hoặc 'displayName', nếu không có thì lấy 'email'
                 return data.get('name') or data.get('email') or "Bạn"
     except Exception as e:
         print(f"⚠️ Lỗi lấy tên user: {e}")
     return "Bạn"
 
-# === 5. HÀM CHATBOT CHÍNH ===
+# === 4b. CACHE CỬA SỔ HỘI THOẠI THEO USER ===
+CHAT_WINDOW_SIZE = 20
+CHAT_WINDOW_MAX_USERS = int(os.getenv("CHAT_WINDOW_MAX_USERS", "500"))
+
+class _UserWindow:
+    """Trạng thái hội thoại của 1 user: tin nhắn gần nhất + bản tóm tắt các lượt cũ."""
+    def __init__(self, messages, summary="", covered_id=""):
+        self.messages = messages          # deque[{"id", "role", "content", "created_at"}]
+        self.summary = summary            # tóm tắt cuộn (rolling summary)
+        # Doc ID (chat_logs) của tin nhắn cuối đã được tóm tắt. Không dùng created_at vì
+        # câu hỏi và câu trả lời của 1 lượt có cùng created_at (độ phân giải 1 giây).
+        self.covered_id = covered_id
+        self.folding_id = ""              # tin nhắn cuối của lần tóm tắt đang chạy nền
+        self.evicted = []                 # tin nhắn bị đẩy khỏi deque khi chưa được tóm tắt
+        self.folding = False              # đang chạy tóm tắt nền
+
+    def _position(self, message_id):
+        """Vị trí của tin nhắn trong deque, -1 nếu không có (đã bị đẩy ra hoặc chưa từng có)."""
+        if message_id:
+            for i, m in enumerate(self.messages):
+                if m["id"] == message_id:
+                    return i
+        return -1
+
+    def covered_ids(self):
+        """ID các tin nhắn trong deque đã (hoặc đang) được tóm tắt: mọi tin từ đầu tới mốc."""
+        upto = max(self._position(self.covered_id), self._position(self.folding_id))
+        return {m["id"] for i, m in enumerate(self.messages) if i <= upto}
+
+class ChatHistoryWindow:
+    """
+    Giữ N tin nhắn gần nhất của mỗi user trong RAM (ring buffer).
+    Chỉ đọc Firestore 1 lần cho mỗi user, sau đó tự cập nhật khi ghi;
+    quá số user tối đa thì bỏ user ít dùng nhất (LRU).
+    """
+    def __init__(self, size=20, max_users=500):
+        self.size = size
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.windows = OrderedDict()  # user_id -> _UserWindow
+
+    @timed("firestore_chat_history_load")
+    def _load(self, user_id):
+        user_doc = db.collection('users').document(user_id)
+        docs = user_doc.collection('chat_logs')\
+                 .order_by('timestamp', direction=firestore.Query.DESCENDING)\
+                 .limit(self.size).stream()
+
+        temp_history = [(doc.id, doc.to_dict()) for doc in docs]
+        temp_history.reverse()
+
+        messages = deque(
+            ({"id": doc_id, "role": msg['role'], "content": msg['content'], "created_at": msg.get('created_at', "")}
+             for doc_id, msg in temp_history if msg.get('role') and msg.get('content')),
+            maxlen=self.size
+        )
+
+        # Bản tóm tắt nằm cạnh chat_logs: users/{uid}/chat_summary/rolling
+        summary, covered_id = "", ""
+        try:
+            summary_doc = user_doc.collection('chat_summary').document('rolling').get()
+            if summary_doc.exists:
+                d = summary_doc.to_dict()
+                summary, covered_id = d.get('summary', ""), d.get('covered_id', "")
+                if not covered_id and d.get('covered_until'):
+                    # Bản tóm tắt cũ lưu mốc created_at: coi như đã tóm tắt tới tin cuối có
+                    # created_at < mốc (lượt cùng giây sẽ được tóm tắt lại, không bị mất)
+                    older = [m for m in messages if m["created_at"] and m["created_at"] < d['covered_until']]
+                    covered_id = older[-1]["id"] if older else ""
+        except Exception as e:
+            print(f"⚠️ Lỗi đọc tóm tắt hội thoại: {e}")
+
+        return _UserWindow(messages, summary, covered_id)
+
+    def _window(self, user_id):
+        with self.lock:
+            window = self.windows.get(user_id)
+            if window is not None:
+                self.windows.move_to_end(user_id)
+                return window
+
+        window = self._load(user_id)
+        with self.lock:
+            # Thread khác có thể đã nạp trong lúc ta đọc Firestore
+            window = self.windows.setdefault(user_id, window)
+            self.windows.move_to_end(user_id)
+            while len(self.windows) > self.max_users:
+                self.windows.popitem(last=False)
+            return window
+
+    def get(self, user_id):
+        """Trả về (list tin nhắn cũ -> mới, bản tóm tắt) của user."""
+        window = self._window(user_id)
+        with self.lock:
+            return [dict(m) for m in window.messages], window.summary
+
+    def append(self, user_id, message_id, role, content, created_at=""):
+        """Thêm tin nhắn mới; user chưa được nạp thì bỏ qua (lần đọc sau sẽ lấy từ Firestore)."""
+        with self.lock:
+            window = self.windows.get(user_id)
+            if window is None:
+                return
+            if len(window.messages) == window.messages.maxlen:
+                # Tin cũ nhất sắp bị đẩy ra: chưa tóm tắt thì giữ lại để lần gộp sau xử lý
+                oldest = window.messages[0]
+                if oldest["id"] not in window.covered_ids():
+                    window.evicted.append(oldest)
+            window.messages.append({"id": message_id, "role": role, "content": content, "created_at": created_at})
+
+    def fold_async(self, user_id, old_messages):
+        """
+        Gộp vào bản tóm tắt (chạy nền): các tin nhắn cũ không còn vừa ngân sách token
+        và các tin đã bị đẩy khỏi deque mà chưa kịp tóm tắt.
+        """
+        with self.lock:
+            window = self.windows.get(user_id)
+            if window is None or window.folding:
+                return
+            covered = window.covered_ids()
+            pending = window.evicted + [m for m in old_messages if m["id"] not in covered]
+            if not pending:
+                return
+            window.evicted = []
+            window.folding = True
+            window.folding_id = pending[-1]["id"]
+            summary = window.summary
+        threading.Thread(target=self._fold, args=(user_id, window, summary, pending), daemon=True).start()
+
+    def _fold(self, user_id, window, summary, pending):
+        covered_id = pending[-1]["id"]
+        try:
+            new_summary = TomTatHoiThoai(summary, pending)
+            write_behind.set(db.collection('users').document(user_id)
+                               .collection('chat_summary').document('rolling'), {
+                "summary": new_summary,
+                "covered_id": covered_id,
+                "timestamp": firestore.SERVER_TIMESTAMP,
+            })
+            with self.lock:
+                window.summary, window.covered_id = new_summary, covered_id
+        except Exception as e:
+            print(f"⚠️ Lỗi tóm tắt hội thoại: {e}")
+            with self.lock:
+                # Tin đã rời deque thì không lấy lại được từ old_messages: trả về hàng chờ
+                in_window = {m["id"] for m in window.messages}
+                window.evicted = [m for m in pending if m["id"] not in in_window] + window.evicted
+        finally:
+            with self.lock:
+                window.folding = False
+                window.folding_id = ""
+
+    def invalidate(self, user_id=None):
+        with self.lock:
+            if user_id is None:
+                self.windows.clear()
+            else:
+                self.windows.pop(user_id, None)
+
+chat_window = ChatHistoryWindow(CHAT_WINDOW_SIZE, CHAT_WINDOW_MAX_USERS)
+
+# === 4c. NGÂN SÁCH TOKEN CHO LỊCH SỬ ===
+# Giữ nguyên văn các lượt gần nhất vừa ngân sách, lượt cũ hơn được gộp vào tóm tắt.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+
+def UocLuongToken(text: str) -> int:
+    """Ước lượng số token (không có tokenizer của Groq): ~3 ký tự tiếng Việt / token."""
+    return len(text or "") // 3 + 1
+
+def ChonLichSuTheoNganSach(tin_nhan: list, ngan_sach: int):
+    """
+    Chia lịch sử thành (quá ngân sách, giữ nguyên văn) - duyệt từ lượt mới nhất về cũ.
+    Chỉ cắt giữa 2 lượt (lượt = tin 'user' + các câu trả lời sau nó), nên câu hỏi và câu
+    trả lời luôn nằm cùng 1 phía và phần giữ lại không bắt đầu bằng câu trả lời mồ côi.
+    """
+    da_dung, cuoi_luot = 0, len(tin_nhan)
+    for i in range(len(tin_nhan) - 1, -1, -1):
+        if tin_nhan[i]["role"] != "user" and i > 0:
+            continue
+        so_token = sum(UocLuongToken(m["content"]) for m in tin_nhan[i:cuoi_luot])
+        if da_dung + so_token > ngan_sach:
+            return tin_nhan[:cuoi_luot], tin_nhan[cuoi_luot:]
+        da_dung += so_token
+        cuoi_luot = i
+    return [], tin_nhan
+
+def TomTatHoiThoai(tom_tat_cu: str, tin_nhan: list) -> str:
+    """Cập nhật bản tóm tắt cuộn bằng model nhỏ: tóm tắt cũ + các lượt mới bị cắt."""
+    doan_hoi_thoai = "\n".join(f"{m['role']}: {m['content']}" for m in tin_nhan)
+    with timed("groq_summary"):
+        completion = client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "Bạn tóm tắt hội thoại giữa người dùng và trợ lý. Giữ lại sự kiện, sở thích, tên riêng và các yêu cầu còn dang dở. Tối đa 120 từ, tiếng Việt."},
+                {"role": "user", "content": f"Tóm tắt hiện có:\n{tom_tat_cu or '(chưa có)'}\n\nCác lượt mới cần gộp vào:\n{doan_hoi_thoai}"},
+            ],
+            temperature=0.2,
+            max_tokens=300,
+            stream=False
+        )
+    return completion.choices[0].message.content.strip()
+
+# Kích thước prompt từng lần gọi (để đo hiệu quả): đã gửi vs nếu gửi nguyên 20 tin nhắn
+_prompt_lock = threading.Lock()
+_prompt_sizes = deque(maxlen=500)
+
+def get_prompt_stats():
+    with _prompt_lock:
+        sizes = list(_prompt_sizes)
+    if not sizes:
+        return {"calls": 0}
+    sent = sorted(s for s, _ in sizes)
+    raw = sorted(r for _, r in sizes)
+    return {
+        "calls": len(sizes),
+        "budget": HISTORY_TOKEN_BUDGET,
+        "p50_prompt_tokens": sent[len(sent) // 2],
+        "p50_uncompacted_tokens": raw[len(raw) // 2],
+        "avg_saved_tokens": round(sum(r - s for s, r in sizes) / len(sizes), 1),
+    }
+
+# === 5. CHUẨN BỊ PROMPT & LƯU LỊCH SỬ (DÙNG CHUNG CHO BẢN THƯỜNG VÀ BẢN STREAM) ===
+def TaoTinNhanGuiAI(truy_van: str, user_id: str = None) -> list:
+    """Ghép system prompt + lịch sử chat (cache của Firebase) + câu hỏi mới."""
+    messages, ghi_nhan = ChuanBiTinNhan(truy_van, user_id)
+    ghi_nhan()
+    return messages
+
+def ChuanBiTinNhan(truy_van: str, user_id: str = None):
+    """
+    Như TaoTinNhanGuiAI nhưng không có tác dụng phụ: trả về (messages, ghi_nhan).
+    ghi_nhan() mới ghi thống kê kích thước prompt và gộp lịch sử cũ vào tóm tắt,
+    để chatbot suy đoán chỉ gọi khi kết quả thực sự được dùng.
+    """
+    # --- BƯỚC 1: LẤY TÊN NGƯỜI DÙNG (CÁ NHÂN HÓA) ---
+    ten_that_cua_user = lay_ten_nguoi_dung(user_id) # <--- Logic mới ở đây
+    
+    # --- BƯỚC 2: LẤY LỊCH SỬ CHAT (CACHE TRONG RAM, FIREBASE LÀ NGUỒN GỐC) ---
+    tin_nhan, tom_tat = chat_window.get(user_id) if user_id else ([], "")
+
+    # Chỉ giữ nguyên văn các lượt gần nhất vừa ngân sách token, phần cũ hơn (và tin đã bị
+    # đẩy khỏi cửa sổ 20 tin) gộp vào tóm tắt (chạy nền)
+    ngan_sach = HISTORY_TOKEN_BUDGET - UocLuongToken(truy_van)
+    bi_cat, giu_lai = ChonLichSuTheoNganSach(tin_nhan, ngan_sach)
+
+    lich_su_gui_ai = [{"role": m["role"], "content": m["content"]} for m in giu_lai]
+
+    # Thêm câu hỏi mới
+    lich_su_gui_ai.append({"role": "user", "content": truy_van})
+
+    # --- BƯỚC 3: CẤU HÌNH SYSTEM (THÊM TÊN NGƯỜI DÙNG VÀO) ---
+    chi_dan = [
+        {
+            "role": "system", 
+            # 👇 Dạy AI biết tên người dùng để xưng hô
+            "content": f"Bạn là trợ lý AI tên {ten_tro_ly}. Người dùng tên là {ten_that_cua_user}. Hãy xưng hô thân mật bằng tên của họ nếu phù hợp. Trả lời ngắn gọn, súc tích."
+        },
+        {"role": "system", "content": LayThongTinThoiGianThuc()},
+        # Thời tiết lấy từ cache (không chờ mạng), thread ngầm ở RealtimeTools tự làm mới
+        {"role": "system", "content": LayThongTinThoiTietDaCache()},
+    ]
+    if tom_tat:
+        chi_dan.append({"role": "system", "content": f"Tóm tắt các lượt trò chuyện trước đó: {tom_tat}"})
+
+    messages = chi_dan + lich_su_gui_ai
+    so_token_gui = sum(UocLuongToken(m["content"]) for m in messages)
+    so_token_goc = sum(UocLuongToken(m["content"]) for m in chi_dan[:3] + tin_nhan) + UocLuongToken(truy_van)
+
+    def ghi_nhan():
+        if user_id:
+            chat_window.fold_async(user_id, bi_cat)
+        with _prompt_lock:
+            _prompt_sizes.append((so_token_gui, so_token_goc))
+    return messages, ghi_nhan
+
+def LuuLichSuChat(user_id: str, truy_van: str, bot_response: str):
+    """Lưu cặp câu hỏi/trả lời vào users/{uid}/chat_logs (ghi nền qua write-behind)."""
+    if not user_id:
+        return
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # 2 lệnh ghi nằm chung 1 batch nên SERVER_TIMESTAMP sẽ trùng nhau;
+    # dùng mốc thời gian phía server Python (+1ms cho câu trả lời) để giữ đúng thứ tự
+    thoi_diem = datetime.now(timezone.utc)
+    user_ref = db.collection('users').document(user_id).collection('chat_logs')
+    # ID document sinh ngay tại client: cửa sổ RAM dùng nó làm mốc tóm tắt
+    user_doc, bot_doc = user_ref.document(), user_ref.document()
+    write_behind.set(user_doc, {
+        "role": "user", "content": truy_van,
+        "timestamp": thoi_diem,
+        "created_at": created_at
+    })
+    write_behind.set(bot_doc, {
+        "role": "assistant", "content": bot_response,
+        "timestamp": thoi_diem + timedelta(milliseconds=1),
+        "created_at": created_at
+    })
+    chat_window.append(user_id, user_doc.id, "user", truy_van, created_at)
+    chat_window.append(user_id, bot_doc.id, "assistant", bot_response, created_at)
+
+# Câu hỏi thời tiết trả lời thẳng từ RealtimeTools (khớp cả "thoi tiet" không dấu)
+_WEATHER_ROUTER = KeywordRouter({"weather": ["thời tiết"]})
+
+def LaCauHoiThoiTiet(truy_van: str) -> bool:
+    return _WEATHER_ROUTER.has(truy_van, "weather")
+
+# === 6. HÀM CHATBOT CHÍNH ===
+@timed("chatbot")
 def ChatBot(truy_van: str, user_id: str = None) -> str:
     
     # 1. Xử lý logic cứng
-    if "thời tiết" in truy_van.lower():
+    if LaCauHoiThoiTiet(truy_van):
         return LayThongTinThoiTiet()
     
     try:
-        # --- BƯỚC 1: LẤY TÊN NGƯỜI DÙNG (CÁ NHÂN HÓA) ---
-        ten_that_cua_user = lay_ten_nguoi_dung(user_id) # <--- Logic mới ở đây
-        
-        # --- BƯỚC 2: LẤY LỊCH SỬ CHAT TỪ FIREBASE ---
-        lich_su_gui_ai = []
-        if user_id:
-            docs = db.collection('users').document(user_id)\
-                     .collection('chat_logs')\
-                     .order_by('timestamp', direction=firestore.Query.DESCENDING)\
-                     .limit(20).stream()
-            
-            temp_history = [doc.to_dict() for doc in docs]
-            temp_history.reverse()
-
-            for msg in temp_history:
-                if msg.get('role') and msg.get('content'):
-                    lich_su_gui_ai.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-
-        # Thêm câu hỏi mới
-        lich_su_gui_ai.append({"role": "user", "content": truy_van})
-
-        # --- BƯỚC 3: CẤU HÌNH SYSTEM (THÊM TÊN NGƯỜI DÙNG VÀO) ---
-        chi_dan = [
-            {
-                "role": "system", 
-                # 👇 Dạy AI biết tên người dùng để xưng hô
-                "content": f"Bạn là trợ lý AI tên {ten_tro_ly}. Người dùng tên là {ten_that_cua_user}. Hãy xưng hô thân mật bằng tên của họ nếu phù hợp. Trả lời ngắn gọn, súc tích."
-            },
-            {"role": "system", "content": LayThongTinThoiGianThuc()},
-            {"role": "system", "content": LayThongTinThoiTiet()},
-        ]
+        messages = TaoTinNhanGuiAI(truy_van, user_id)
 
         # --- BƯỚC 4: GỌI AI ---
-        # (Phần này giữ nguyên không đổi)
-        completion = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=chi_dan + lich_su_gui_ai,
-            temperature=0.7,
-            max_tokens=1024,
-            stream=False
-        )
+        with timed("groq_chat"):
+            completion = client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1024,
+                stream=False
+            )
         
         bot_response = completion.choices[0].message.content
         bot_response = SuaDinhDangTraLoi(bot_response)
 
         # --- BƯỚC 5: LƯU LỊCH SỬ ---
-        if user_id:
-            user_ref = db.collection('users').document(user_id).collection('chat_logs')
-            user_ref.add({
-                "role": "user", "content": truy_van,
-                "timestamp": firestore.SERVER_TIMESTAMP,
-                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            user_ref.add({
-                "role": "assistant", "content": bot_response,
-                "timestamp": firestore.SERVER_TIMESTAMP,
-                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
+        LuuLichSuChat(user_id, truy_van, bot_response)
 
         return bot_response
 
@@ -127,6 +396,169 @@ def ChatBot(truy_van: str, user_id: str = None) -> str:
         print(f"❌ Lỗi Chatbot: {e}")
         return "Xin lỗi, hệ thống đang bận."
 
+# === 7. HÀM CHATBOT STREAM (TRẢ TỪNG ĐOẠN TOKEN) ===
+def ChatBotStream(truy_van: str, user_id: str = None):
+    """
+    Giống ChatBot nhưng là generator: yield từng đoạn text ngay khi Groq trả về.
+    Lịch sử chỉ được lưu lên Firebase sau khi stream kết thúc.
+    Stream đứt giữa chừng: phần đã nhận vẫn được lưu, exception được ném tiếp để
+    server gửi dòng 'error' cho Frontend.
+    """
+    if LaCauHoiThoiTiet(truy_van):
+        yield LayThongTinThoiTiet()
+        return
+
+    # Không dùng @timed("chatbot"): với generator nó chỉ đo lúc tạo generator
+    bat_dau_chatbot = time.perf_counter()
+    da_gui = False
+    cac_doan = []
+    try:
+        messages = TaoTinNhanGuiAI(truy_van, user_id)
+
+        bat_dau = time.perf_counter()
+        stream = client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=1024,
+            stream=True
+        )
+
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if not da_gui:
+                    observe_stage("groq_first_token", time.perf_counter() - bat_dau)
+                cac_doan.append(delta)
+                da_gui = True
+                yield delta
+        observe_stage("groq_chat_stream", time.perf_counter() - bat_dau)
+
+        bot_response = SuaDinhDangTraLoi("".join(cac_doan))
+        try:
+            LuuLichSuChat(user_id, truy_van, bot_response)
+        except Exception as e:
+            print(f"⚠️ Lỗi lưu lịch sử chat: {e}")
+
+    except Exception as e:
+        print(f"❌ Lỗi Chatbot (stream): {e}")
+        stage_errors.inc(stage="chatbot")
+        if not da_gui:
+            yield "Xin lỗi, hệ thống đang bận."
+            return
+        # Đứt giữa chừng: lưu phần đã sinh để lịch sử khớp với những gì người dùng đã thấy
+        try:
+            LuuLichSuChat(user_id, truy_van, SuaDinhDangTraLoi("".join(cac_doan)))
+        except Exception as e_luu:
+            print(f"⚠️ Lỗi lưu lịch sử chat: {e_luu}")
+        raise
+    finally:
+        observe_stage("chatbot", time.perf_counter() - bat_dau_chatbot)
+
+# === 8. CHẠY CHATBOT SUY ĐOÁN (SONG SONG VỚI BƯỚC PHÂN LOẠI) ===
+# Phần lớn câu hỏi cuối cùng được phân loại là 'chung ...', nên có thể gọi Groq
+# ngay khi nhận text, cùng lúc với Cohere. Nếu phân loại khớp thì dùng luôn kết quả,
+# nếu không thì hủy stream và ghi nhận số token bị lãng phí.
+_speculation_lock = threading.Lock()
+_speculation_stats = {"started": 0, "won": 0, "lost": 0, "wasted_tokens": 0}
+
+def get_speculation_stats():
+    with _speculation_lock:
+        stats = dict(_speculation_stats)
+    decided = stats["won"] + stats["lost"]
+    stats["win_rate"] = round(stats["won"] / decided, 3) if decided else 0.0
+    return stats
+
+class SpeculativeChat:
+    def __init__(self, truy_van: str, user_id: str, executor):
+        self.truy_van = truy_van
+        self.user_id = user_id
+        self.huy = threading.Event()
+        self.so_token = 0
+        self.cond = threading.Condition()
+        self.cac_doan = []        # các đoạn Groq đã trả về (để stream lại cho client khi thắng)
+        self.xong = False
+        self.ghi_nhan = None      # tác dụng phụ của bước ghép prompt, chỉ chạy khi thắng
+        with _speculation_lock:
+            _speculation_stats["started"] += 1
+        self.future = executor.submit(self._chay)
+
+    def _chay(self):
+        """Gọi Groq (stream) nhưng KHÔNG lưu lịch sử, KHÔNG ghi thống kê prompt; dừng ngay khi bị hủy."""
+        try:
+            messages, self.ghi_nhan = ChuanBiTinNhan(self.truy_van, self.user_id)
+            stream = client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1024,
+                stream=True
+            )
+            try:
+                for chunk in stream:
+                    if self.huy.is_set():
+                        return None
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        # Mỗi chunk của Groq tương ứng ~1 token sinh ra
+                        self.so_token += 1
+                        with self.cond:
+                            self.cac_doan.append(delta)
+                            self.cond.notify_all()
+            finally:
+                if self.huy.is_set() and hasattr(stream, "close"):
+                    stream.close()
+            return SuaDinhDangTraLoi("".join(self.cac_doan))
+        finally:
+            with self.cond:
+                self.xong = True
+                self.cond.notify_all()
+
+    def stream(self):
+        """
+        Phân loại khớp và client nhận 'chat-delta': yield các đoạn đã sinh (kể cả phần có
+        trước lúc gọi) rồi tiếp tục theo Groq. Sau đó gọi use() để lấy câu trả lời cuối.
+        """
+        da_gui = 0
+        while True:
+            with self.cond:
+                while len(self.cac_doan) == da_gui and not self.xong:
+                    self.cond.wait()
+                moi = self.cac_doan[da_gui:]
+                xong = self.xong
+            da_gui += len(moi)
+            yield from moi
+            if xong and da_gui >= len(self.cac_doan):
+                return
+
+    def use(self):
+        """Phân loại khớp: chờ kết quả, lưu lịch sử như ChatBot và trả về câu trả lời."""
+        try:
+            bot_response = self.future.result()
+        except Exception as e:
+            print(f"❌ Lỗi Chatbot (suy đoán): {e}")
+            self.discard()
+            return None
+        with _speculation_lock:
+            _speculation_stats["won"] += 1
+        if self.ghi_nhan:
+            self.ghi_nhan()
+        try:
+            LuuLichSuChat(self.user_id, self.truy_van, bot_response)
+        except Exception as e:
+            print(f"⚠️ Lỗi lưu lịch sử chat: {e}")
+        return bot_response
+
+    def discard(self):
+        """Phân loại không khớp: hủy stream, cộng số token đã sinh vào thống kê lãng phí."""
+        self.huy.set()
+        self.future.cancel()
+        def ghi_nhan(_):
+            with _speculation_lock:
+                _speculation_stats["lost"] += 1
+                _speculation_stats["wasted_tokens"] += self.so_token
+        self.future.add_done_callback(ghi_nhan)
+
 # Test (Không quan trọng lắm vì chạy server là chính)
 if __name__ == "__main__":
     print("Chatbot Firebase Mode")
\ No newline at end of file
@@ -1,17 +1,31 @@
 # File: Backend/ImageGeneration.py
 # (Phiên bản chuẩn hóa - tạo 1 ảnh duy nhất + 3 hàm nâng cao)
 import asyncio
+import threading
+from concurrent.futures import as_completed
 from random import randint
 from PIL import Image
-import requests
+from http_client import http_post
+from metrics import timed, observe_stage
+from ttl_cache import TTLCache
+from disk_cache import disk_cache, NAMESPACE_TTLS
 from dotenv import get_key
 import os
 import time
+import hashlib
+import uuid
 from deep_translator import GoogleTranslator
 
 # Thêm import save_history
 from history import save_history
 
+# HTTP client bất đồng bộ (tuỳ chọn): có httpx thì mọi request HuggingFace dùng chung
+# 1 AsyncClient giữ kết nối; không có thì chạy http_post (Session dùng chung) trong thread.
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 # --- 1. Lấy API Key ---
 env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env'))
 HUGGINGFACE_API_KEY = get_key(env_path, 'HUGGINGFACE_API_KEY')
@@ -28,105 +42,348 @@ else:
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-# --- 3. Hàm gọi API ---
+# --- 2b. Tên file theo nội dung + gộp request trùng ---
+# Ảnh được lưu theo khoá (prompt đã chuẩn hoá, seed): cùng prompt + seed thì cùng file,
+# khác seed thì không ghi đè nhau. GenerateImages(use_cache=True) dùng seed cố định nên
+# lần sau trả luôn file có sẵn; RegenerateLastImage / GenerateVariant luôn lấy seed mới.
+CACHE_SEED = 0
+_inflight = TTLCache(max_size=200, default_ttl=1, name="image")  # chỉ dùng để gộp, không giữ kết quả
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.lower().split())
+
+def image_path_for(prompt: str, seed: int) -> str:
+    digest = hashlib.sha256(f"{normalize_prompt(prompt)}|{seed}".encode("utf-8")).hexdigest()[:16]
+    safe_name = ''.join(c for c in prompt if c.isalnum() or c in ' _-').strip().replace(" ", "_")[:40]
+    return os.path.join(DATA_DIR, f"{safe_name}-{digest}.jpg")
+
+def _anh_hop_le(path: str) -> bool:
+    return os.path.exists(path) and os.path.getsize(path) > 1000
+
+# --- 2c. Chỉ mục ảnh đã hoàn tất ---
+# Ảnh được ghi ra file tạm rồi os.replace sang tên thật, nên file .jpg đã thấy là file đầy đủ:
+# không còn vòng sleep chờ kích thước file. Ảnh xong được ghi vào ImageIndex; "ảnh mới nhất"
+# đọc O(1) thay vì os.listdir + getctime cả thư mục Data, và ai cần chờ ảnh mới thì wait()
+# trên Condition (được notify) thay vì sleep-poll.
+_TMP_SUFFIX = ".tmp"
+_TMP_MAX_AGE = 600  # file tạm cũ hơn 10 phút là rác của lần chạy bị ngắt
+
+class ImageIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self.cond = threading.Condition()
+        self.version = 0  # tăng mỗi lần có ảnh hoàn tất
+        # Quét thư mục đúng 1 lần lúc khởi tạo (import), trước khi có ảnh nào đang ghi
+        self.latest = self._scan()
+
+    def _scan(self):
+        """Ảnh .jpg mới nhất trong thư mục; đồng thời dọn file tạm sót lại từ lần chạy trước."""
+        newest, newest_time = None, -1.0
+        stale_before = time.time() - _TMP_MAX_AGE
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    name = entry.name.lower()
+                    if name.endswith(_TMP_SUFFIX):
+                        # Chỉ xoá file tạm đã cũ: file mới có thể là ảnh của tiến trình khác đang ghi
+                        try:
+                            if entry.stat().st_mtime < stale_before:
+                                os.remove(entry.path)
+                        except OSError:
+                            pass
+                    elif name.endswith(".jpg"):
+                        mtime = entry.stat().st_mtime
+                        if mtime > newest_time:
+                            newest, newest_time = entry.path, mtime
+        except OSError as e:
+            print(f"⚠️ [ImageIndex] Không quét được {self.directory}: {e}")
+        return newest
+
+    def add(self, path):
+        with self.cond:
+            self.latest = path
+            self.version += 1
+            self.cond.notify_all()
+
+    def get(self):
+        """(đường dẫn ảnh mới nhất hoặc None, version)."""
+        with self.cond:
+            return self.latest, self.version
+
+    def wait_newer(self, version, timeout):
+        """Chờ tối đa timeout giây tới khi có ảnh mới hơn version; trả về như get()."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.version <= version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.latest, self.version
+
+image_index = ImageIndex(DATA_DIR)
+
+# --- 3. Event loop + HTTP client dùng chung ---
+# Trước đây mỗi lần tạo ảnh là 1 asyncio.run() (tạo rồi huỷ event loop). Giờ có 1 event
+# loop sống suốt tiến trình trên thread nền; mọi coroutine tạo ảnh được gửi vào đó và
+# semaphore giới hạn số request HuggingFace chạy đồng thời.
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", "4"))
+IMAGE_MAX_VARIANTS = 4
+
+class _ImageLoop:
+    def __init__(self, concurrency=IMAGE_CONCURRENCY):
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+
+    def _start(self):
+        with self.lock:
+            if self.loop is not None:
+                return self.loop
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True, name="image-loop").start()
+
+            async def setup():
+                self.semaphore = asyncio.Semaphore(self.concurrency)
+                if httpx is not None:
+                    self.client = httpx.AsyncClient(
+                        timeout=httpx.Timeout(120, connect=5),
+                        limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+                    )
+            asyncio.run_coroutine_threadsafe(setup(), loop).result()
+            self.loop = loop
+            return loop
+
+    def submit(self, coro):
+        """Chạy coroutine trên loop dùng chung, trả về concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._start())
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+image_loop = _ImageLoop()
+
 async def query(payload):
     if not headers:
         return b"error: Missing API key"
+    async with image_loop.semaphore:
+        # Không dùng `with timed(...)` vì nhiều coroutine đan xen trên cùng 1 thread
+        start = time.perf_counter()
+        try:
+            if image_loop.client is not None:
+                response = await image_loop.client.post(API_URL, headers=headers, json=payload)
+            else:
+                response = await asyncio.to_thread(http_post, API_URL, headers=headers, json=payload, timeout=(5, 120))
+            return response.content
+        except Exception as e:
+            return f"error: {e}".encode("utf-8")
+        finally:
+            observe_stage("hf_image", time.perf_counter() - start)
+
+# --- 4. Hàm dịch prompt (có cache) ---
+# Trước đây mỗi lần tạo ảnh (kể cả tạo lại cùng prompt) đều gọi GoogleTranslator chặn luồng.
+# Bản dịch vi -> en gần như không đổi: giữ trong RAM (giới hạn số mục) và trên đĩa
+# (namespace "translate") để còn qua các lần restart. Dịch lỗi thì không cache.
+_translations = TTLCache(max_size=500, default_ttl=NAMESPACE_TTLS["translate"], name="translate")
+
+@timed("translate")
+def _dich(text: str):
     try:
-        response = await asyncio.to_thread(requests.post, API_URL, headers=headers, json=payload)
-        return response.content
+        return GoogleTranslator(source='vi', target='en').translate(text) or None
     except Exception as e:
-        return f"error: {e}".encode("utf-8")
+        print(f"⚠️ [ImageGeneration] Lỗi dịch prompt: {e}")
+        return None
 
-# --- 4. Hàm dịch prompt ---
 def translate_prompt(prompt: str) -> str:
-    try:
-        return GoogleTranslator(source='vi', target='en').translate(prompt)
-    except:
+    key = normalize_prompt(prompt)
+    if not key:
         return prompt
+    prompt_en = _translations.get_or_load(
+        key, lambda: disk_cache.get_or_load("translate", key, lambda: _dich(prompt)),
+        cacheable=lambda v: v is not None
+    )
+    return prompt_en or prompt
+
+def translate_prompts(prompts):
+    """
+    Dịch nhiều prompt, trả về list cùng thứ tự. Các prompt chưa có trong cache được nối bằng
+    xuống dòng và dịch trong 1 request; nếu số dòng trả về bị lệch thì dịch lại từng câu.
+    """
+    originals = {}  # key -> prompt gốc (lần xuất hiện đầu)
+    for prompt in prompts:
+        originals.setdefault(normalize_prompt(prompt), prompt)
+    originals.pop("", None)
+
+    result, missing = {}, []
+    for key in originals:
+        prompt_en = _translations.get(key)
+        if prompt_en is None:
+            prompt_en = disk_cache.get("translate", key)
+            if prompt_en is not None:
+                _translations.set(key, prompt_en)
+        if prompt_en is None:
+            missing.append(key)
+        else:
+            result[key] = prompt_en
+
+    if len(missing) > 1:
+        lines = (_dich("\n".join(originals[k] for k in missing)) or "").split("\n")
+        if len(lines) == len(missing) and all(line.strip() for line in lines):
+            for key, line in zip(missing, lines):
+                result[key] = line.strip()
+                _translations.set(key, result[key])
+                disk_cache.set("translate", key, result[key])
+            missing = []
+    for key in missing:
+        result[key] = translate_prompt(originals[key])
+
+    return [result.get(normalize_prompt(p), p) for p in prompts]
+
+def prefetch_translation(prompt: str):
+    """Dịch trước trên event loop (không chặn): job tạo ảnh tới lượt sẽ lấy từ cache."""
+    return image_loop.submit(asyncio.to_thread(translate_prompt, prompt))
 
 # --- 5. Hàm tạo ảnh chính ---
-async def generate_image(prompt: str):
-    prompt_en = translate_prompt(prompt)
+def _GhiAnh(save_path: str, image_bytes: bytes):
+    # Ghi ra file tạm cùng thư mục rồi đổi tên (nguyên tử): UI không bao giờ đọc phải ảnh dở dang
+    tmp_path = f"{save_path}.{uuid.uuid4().hex[:8]}{_TMP_SUFFIX}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(image_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    image_index.add(save_path)
+
+async def generate_image(prompt: str, seed: int = None, use_cache: bool = False, prompt_en: str = None):
+    # Dịch chạy song song với phần chuẩn bị còn lại (đẩy ra thread, không chặn loop);
+    # nhiều ảnh cùng prompt chạy đồng thời chỉ tốn 1 lần dịch nhờ cache gộp request.
+    translation = None
+    if prompt_en is None:
+        translation = asyncio.ensure_future(asyncio.to_thread(translate_prompt, prompt))
+
+    seed = randint(0, 1000000) if seed is None else seed
+    save_path = image_path_for(prompt, seed)
+    if use_cache and _anh_hop_le(save_path):
+        print(f"♻️ Dùng lại ảnh đã có: {save_path}")
+        image_index.add(save_path)
+        return save_path
+
+    if translation is not None:
+        prompt_en = await translation
     full_prompt = (
         f"{prompt_en}, ultra realistic, detailed, professional lighting, "
-        f"4K resolution, cinematic tone, seed={randint(0, 1000000)}"
+        f"4K resolution, cinematic tone, seed={seed}"
     )
 
-    payload = {"inputs": full_prompt}
+    payload = {"inputs": full_prompt, "parameters": {"seed": seed}}
     image_bytes = await query(payload)
 
-    safe_name = ''.join(c for c in prompt if c.isalnum() or c in ' _-').strip().replace(" ", "_")
-    save_path = os.path.join(DATA_DIR, f"{safe_name}.jpg")
-
     if image_bytes.startswith(b"error:"):
         print(f"❌ Lỗi tạo ảnh: {image_bytes.decode('utf-8')}")
         return None
 
-    # Ghi file ảnh xuống ổ đĩa
-    with open(save_path, "wb") as f:
-        f.write(image_bytes)
-        f.flush()
-        os.fsync(f.fileno())
-
-    # ✅ Đợi file thực sự được ghi xong (tránh UI load quá sớm)
-    for _ in range(10):  # tối đa 10 lần (3s)
-        if os.path.exists(save_path) and os.path.getsize(save_path) > 1000:
-            break
-        time.sleep(0.3)
+    # Ghi file (chặn I/O) trong thread để không giữ event loop của các ảnh khác
+    await asyncio.to_thread(_GhiAnh, save_path, image_bytes)
 
     print(f"💾 Đã lưu ảnh: {save_path}")
     return save_path
 
 # --- 6. Gọi hàm đồng bộ ---
-def GenerateImages(prompt: str):
-    """Tạo 1 ảnh duy nhất từ prompt gốc."""
+def GenerateImages(prompt: str, use_cache: bool = False, seed: int = None, prompt_en: str = None):
+    """
+    Tạo 1 ảnh duy nhất từ prompt gốc.
+    use_cache=True: cùng prompt trả lại ảnh đã sinh (seed cố định) thay vì gọi lại HuggingFace.
+    Các lời gọi trùng prompt đang chạy đồng thời dùng chung 1 lần gọi HuggingFace
+    (trừ khi truyền seed riêng, VD: tạo lại ảnh).
+    """
+    if use_cache and seed is None:
+        seed = CACHE_SEED
+    flight_key = f"{normalize_prompt(prompt)}|{'*' if seed is None else seed}"
+    return _inflight.get_or_load(
+        flight_key, lambda: _TaoAnh(prompt, seed, use_cache, prompt_en), cacheable=lambda _: False
+    )
+
+def _SauKhiTaoAnh(prompt: str, path: str):
+    # Hiển thị ảnh (giữ như cũ)
     try:
-        path = asyncio.run(generate_image(prompt))
-        if path:
-            # Hiển thị ảnh (giữ như cũ)
-            try:
-                img = Image.open(path)
-                img.show()
-            except Exception:
-                pass
-
-            # --- GHI LỊCH SỬ TẠO ẢNH VÀO CHAT HISTORY ---
-            try:
-                save_history({
-                    "id": f"gen-{time.time()}",
-                    "type": "ai-image",
-                    "prompt": prompt,
-                    "image_path": path
-                })
-            except Exception as e:
-                print(f"⚠️ [ImageGeneration] Lỗi khi gọi save_history: {e}")
+        img = Image.open(path)
+        img.show()
+    except Exception:
+        pass
+
+    # --- GHI LỊCH SỬ TẠO ẢNH VÀO CHAT HISTORY ---
+    try:
+        save_history({
+            "id": f"gen-{time.time()}",
+            "type": "ai-image",
+            "prompt": prompt,
+            "image_path": path
+        })
+    except Exception as e:
+        print(f"⚠️ [ImageGeneration] Lỗi khi gọi save_history: {e}")
 
+@timed("image_generate")
+def _TaoAnh(prompt: str, seed: int = None, use_cache: bool = False, prompt_en: str = None):
+    try:
+        path = image_loop.run(generate_image(prompt, seed=seed, use_cache=use_cache, prompt_en=prompt_en))
+        if path:
+            _SauKhiTaoAnh(prompt, path)
         return path
     except Exception as e:
         print(f"❌ Lỗi khi tạo ảnh: {e}")
         return None
 
+# --- 6b. Tạo nhiều ảnh song song ---
+def GenerateImageVariants(prompt: str, n: int = 4):
+    """
+    Tạo n ảnh (n seed khác nhau) cùng lúc trên event loop dùng chung.
+    Generator: yield đường dẫn từng ảnh ngay khi ảnh đó xong (ảnh lỗi bị bỏ qua),
+    nên 4 ảnh tốn xấp xỉ thời gian của 1 lần sinh ảnh (trong giới hạn IMAGE_CONCURRENCY).
+    """
+    n = max(1, min(n, IMAGE_MAX_VARIANTS))
+    # Không dịch trước: n coroutine cùng gọi translate_prompt và được gộp thành 1 lần dịch
+    futures = [
+        image_loop.submit(generate_image(prompt, seed=randint(0, 1000000)))
+        for _ in range(n)
+    ]
+    for future in as_completed(futures):
+        try:
+            path = future.result()
+        except Exception as e:
+            print(f"❌ Lỗi khi tạo ảnh biến thể: {e}")
+            continue
+        if path:
+            _SauKhiTaoAnh(prompt, path)
+            yield path
+
 # --- 7. Tạo lại ảnh cùng nội dung ---
 def RegenerateLastImage(prompt: str):
     """Tạo lại ảnh cùng prompt cũ với seed mới."""
     print("🔁 Đang tái tạo lại ảnh cùng nội dung...")
-    return GenerateImages(prompt)
+    return GenerateImages(prompt, seed=randint(0, 1000000))
 
 # --- 8. Tạo ảnh biến thể nhẹ ---
 def GenerateVariant(prompt: str, variation: str):
     """Tạo ảnh cùng chủ đề nhưng có chỉnh nhẹ (ví dụ: thêm vật thể, đổi màu...)."""
     print(f"🎨 Đang tạo ảnh biến thể: {variation}")
     new_prompt = f"{prompt}, {variation}"
-    return GenerateImages(new_prompt)
+    # Prompt gốc thường đã có trong cache, chỉ phần biến thể là cần dịch (gộp 1 request nếu cả 2 đều thiếu)
+    prompt_en, variation_en = translate_prompts([prompt, variation])
+    return GenerateImages(new_prompt, seed=randint(0, 1000000), prompt_en=f"{prompt_en}, {variation_en}")
 
 # --- 9. Lấy ảnh mới nhất ---
 def get_latest_image_path():
-    """Trả về đường dẫn ảnh gần nhất trong thư mục Data."""
-    files = [os.path.join(DATA_DIR, f) for f in os.listdir(DATA_DIR) if f.lower().endswith(".jpg")]
-    if not files:
-        return None
-    return max(files, key=os.path.getctime)
+    """Trả về đường dẫn ảnh gần nhất (đã ghi xong) trong thư mục Data."""
+    return image_index.get()[0]
 
 # --- 10. Test ---
 if __name__ == "__main__":
@@ -1,6 +1,13 @@
 # Backend/Model.py (ĐÃ NÂNG CẤP)
 import sys
 import os 
+import re
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import deque, OrderedDict
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(current_dir, '..'))
 sys.path.append(project_root)
@@ -8,6 +15,7 @@ sys.path.append(project_root)
 import cohere
 from dotenv import load_dotenv
 from utils import safe_print
+from metrics import timed, observe_stage
 env_path = os.path.join(project_root, '.env')
 load_dotenv(env_path)
 
@@ -28,6 +36,10 @@ except Exception as e:
     exit()
 
 
+COHERE_MODEL = 'command-nightly'
+# Task trả về khi Cohere lỗi (không được đưa vào cache)
+LLM_ERROR_TASK = "chung Lỗi khi phân loại lệnh"
+
 # === 2. NÂNG CẤP: Thêm chức năng mới ===
 # Define a list of recognized function keywords for task categorization (Tiếng Việt).
 # Các từ khóa này PHẢI khớp với định dạng output trong preamble
@@ -65,6 +77,7 @@ Nhiệm vụ của bạn là xác định xem truy vấn thuộc loại 'chung',
 -> Phản hồi với định dạng 'phát ( tên bài hát )' nếu truy vấn yêu cầu phát bài hát. Ví dụ: 'phát Nấu ăn cho em'.
 
 -> Phản hồi với định dạng 'tạo ảnh ( mô tả ảnh )' nếu truy vấn yêu cầu tạo ảnh với mô tả. Ví dụ: 'tạo ảnh con sư tử'.
+    - Nếu yêu cầu nhiều ảnh thì giữ nguyên số lượng ở đầu mô tả. Ví dụ: 'vẽ cho tôi 3 tấm hình con mèo' => phản hồi 'tạo ảnh 3 tấm hình con mèo'.
 
 -> Phản hồi với định dạng 'nhắc nhở ( thời gian nội dung )' nếu truy vấn yêu cầu đặt lời nhắc. Ví dụ: 'nhắc tôi 9h tối mai họp' => phản hồi 'nhắc nhở 9:00pm ngày mai họp'.
 
@@ -107,29 +120,307 @@ ChatHistory = [
     {'role': 'Chatbot', 'message': "phân tích màn hình bạn thấy gì trên màn hình, gọi zalo Ba"}
 ]
 
-# Define the main function for decision-making on queries.
-def FirstLayerLLM(prompt: str = "test"):
+# === 4. BỘ PHÂN LOẠI NHANH (PRE-ROUTER) ===
+# Các lệnh có tiền tố rõ ràng ("mở chrome", "tạo ảnh con mèo", "gọi zalo mẹ"...)
+# được phân loại ngay tại chỗ bằng regex, không cần gọi Cohere.
+# Mỗi luật: (tên func, regex). Nhóm 'arg' (nếu có) là phần nội dung đi kèm lệnh.
+# Nếu regex không có nhóm 'arg' thì dùng nguyên câu làm nội dung.
+# Luật chỉ được khớp khi CHẮC CHẮN (khớp nhầm là bỏ qua Cohere): 'mở'/'đóng' cần tên ứng dụng
+# đã biết hoặc tiền tố 'ứng dụng/app/trang', 'phát' cần từ bài/nhạc/video, câu hỏi thì nhường LLM.
+KNOWN_APPS = [
+    "chrome", "google chrome", "cốc cốc", "edge", "firefox", "facebook", "messenger", "zalo",
+    "youtube", "google", "gmail", "tiktok", "instagram", "twitter", "telegram", "discord",
+    "spotify", "netflix", "shopee", "github", "chatgpt", "notepad", "word", "excel",
+    "powerpoint", "outlook", "teams", "zoom", "skype", "paint", "calculator", "máy tính",
+    "cmd", "terminal", "file explorer", "vscode", "visual studio code", "steam", "camera",
+    "cài đặt", "settings",
+]
+_apps_pattern = "|".join(re.escape(a) for a in sorted(KNOWN_APPS, key=len, reverse=True))
+_app_target = rf"(?:(?:ứng dụng|app|trang web|trang) (?P<arg>[^\s]+(?: [^\s]+){{0,2}})|(?P<app>{_apps_pattern}))"
+
+PRE_ROUTER_RULES = [
+    ("thoát", r"(?:tạm biệt|bye|goodbye|thoát)(?: vist)?"),
+    ("hệ thống", r"(?:tắt tiếng|bật tiếng|tăng âm lượng|giảm âm lượng)"),
+    # Nhiều ảnh: giữ số lượng trong nội dung ("tạo 4 ảnh con mèo" -> "tạo ảnh 4 ảnh con mèo")
+    ("tạo ảnh", r"(?:tạo|vẽ|vẽ cho tôi|tạo cho tôi) (?P<arg>(?:[2-9]|hai|ba|bốn|năm) (?:bức |tấm )?(?:ảnh|hình|tranh) .+)"),
+    ("tạo ảnh", r"(?:tạo|vẽ|vẽ cho tôi|tạo cho tôi) (?:một |1 )?(?:bức |tấm )?(?:ảnh|hình|hình ảnh|tranh) (?P<arg>.+)"),
+    ("nhắc nhở", r"(?:nhắc tôi|nhắc nhở tôi|nhắc nhở|đặt lời nhắc|đặt nhắc nhở) (?P<arg>.+)"),
+    ("gọi zalo", r"gọi (?:video |thoại )?(?:zalo cho|zalo) (?P<arg>[^\s].{0,30})"),
+    ("gọi zalo", r"gọi (?:video |thoại )?(?:cho )?(?P<arg>[^\s].{0,30}?) (?:trên|bằng|qua) zalo"),
+    # "tìm hiểu ..." là động từ, không phải lệnh tìm
+    ("tìm google", r"(?:tìm kiếm|tìm|search)(?! hiểu\b) (?:trên )?google (?P<arg>.+)"),
+    ("tìm google", r"(?:tìm kiếm|tìm|search)(?! hiểu\b) (?P<arg>.+?) (?:trên|bằng) google"),
+    ("tìm youtube", r"(?:tìm kiếm|tìm|search)(?! hiểu\b) (?:trên )?youtube (?P<arg>.+)"),
+    ("tìm youtube", r"(?:tìm kiếm|tìm|search)(?! hiểu\b) (?P<arg>.+?) (?:trên|bằng) youtube"),
+    ("phát", r"(?:phát|mở|bật) (?:bài hát|bài|nhạc|video) (?P<arg>.+)"),
+    ("mở", r"mở " + _app_target),
+    ("đóng", r"đóng " + _app_target),
+    ("phân tích màn hình", r"(?:phân tích màn hình|bạn thấy gì trên màn hình|trên màn hình (?:có|là) gì)(?: (?P<arg>.+))?\??"),
+]
+
+# Chỉ dùng luật nếu tên func thực sự nằm trong funcs (khớp với preamble)
+_compiled_rules = [
+    (func, re.compile(pattern, re.IGNORECASE))
+    for func, pattern in PRE_ROUTER_RULES
+    if func in funcs
+]
+
+# Câu hỏi ("phát triển web là gì", "vẽ hình tròn thế nào?") không phải lệnh: nhường cho LLM
+_question = re.compile(
+    r"(?:\?\s*$|\b(?:là gì|là ai|thế nào|ra sao|tại sao|vì sao|bao nhiêu|có phải)\b)", re.IGNORECASE
+)
+
+# Các từ nối tách nhiều lệnh trong 1 câu ("mở facebook và gọi zalo cho mẹ")
+_task_separator = re.compile(r"\s*(?:,|;|\bvà\b|\brồi\b|\bsau đó\b|\btiện thể\b)\s*", re.IGNORECASE)
+
+def _match_rule(part: str):
+    """Trả về task ('mở chrome') nếu đoạn text khớp trọn vẹn 1 luật, ngược lại None."""
+    part = part.strip().rstrip(".!")
+    for func, pattern in _compiled_rules:
+        m = pattern.fullmatch(part)
+        if not m:
+            continue
+        if func != "phân tích màn hình" and _question.search(part):
+            return None
+        groups = m.groupdict()
+        arg = (groups.get("arg") or groups.get("app") or "").strip()
+        if func == "thoát":
+            return func
+        if func in ("hệ thống", "phân tích màn hình") and not arg:
+            arg = part
+        return f"{func} {arg}" if arg else None
+    return None
+
+def PreRoute(prompt: str):
     """
-    Hàm này nhận prompt (text từ STT), gọi Cohere để phân loại,
-    và trả về một list các nhiệm vụ đã được lọc.
-    Ví dụ: ['mở facebook', 'chung thời tiết hôm nay']
+    Phân loại nhanh bằng luật. Trả về list task nếu CHẮC CHẮN, ngược lại None
+    (để FirstLayerLLM chuyển sang Cohere).
     """
+    text = (prompt or "").strip()
+    if not text:
+        return None
+
+    parts = [p for p in _task_separator.split(text) if p.strip()]
+    if len(parts) > 1:
+        # Câu có nhiều vế: mọi vế đều phải khớp luật, thiếu 1 vế là nhường cho LLM
+        tasks = [_match_rule(p) for p in parts]
+        return tasks if all(tasks) else None
+
+    task = _match_rule(text)
+    return [task] if task else None
+
+# Bảng ví dụ để kiểm tra luật (python Model.py --check-rules): câu -> task mong đợi,
+# None nghĩa là luật KHÔNG được khớp và câu phải đi qua Cohere.
+PRE_ROUTER_EXAMPLES = [
+    ("mở chrome", ["mở chrome"]),
+    ("mở ứng dụng zalo", ["mở zalo"]),
+    ("mở trang vnexpress", ["mở vnexpress"]),
+    ("đóng notepad", ["đóng notepad"]),
+    ("mở facebook và gọi zalo cho mẹ", ["mở facebook", "gọi zalo mẹ"]),
+    ("phát bài hát lạc trôi", ["phát lạc trôi"]),
+    ("bật nhạc sơn tùng", ["phát sơn tùng"]),
+    ("tạo ảnh con mèo", ["tạo ảnh con mèo"]),
+    ("tạo 4 ảnh con mèo", ["tạo ảnh 4 ảnh con mèo"]),
+    ("tạo bốn tấm ảnh con mèo", ["tạo ảnh bốn tấm ảnh con mèo"]),
+    ("nhắc tôi 9h tối mai họp", ["nhắc nhở 9h tối mai họp"]),
+    ("tìm trên google thời tiết hà nội", ["tìm google thời tiết hà nội"]),
+    ("tìm lạc trôi trên youtube", ["tìm youtube lạc trôi"]),
+    ("tắt tiếng", ["hệ thống tắt tiếng"]),
+    ("tạm biệt vist", ["thoát"]),
+    ("bạn thấy gì trên màn hình?", ["phân tích màn hình bạn thấy gì trên màn hình?"]),
+    ("phát triển web là gì", None),
+    ("phát hiện sớm ung thư", None),
+    ("đóng góp ý kiến", None),
+    ("mở đầu bài văn", None),
+    ("mở rộng", None),
+    ("vẽ hình tròn là gì", None),
+    ("nhắc nhở là gì", None),
+    ("tìm hiểu về lịch sử việt nam trên google", None),
+    ("mở chrome thế nào?", None),
+]
+
+def check_pre_router():
+    """Chạy PreRoute trên PRE_ROUTER_EXAMPLES, trả về list (câu, mong đợi, thực tế) bị sai."""
+    return [(text, expected, PreRoute(text)) for text, expected in PRE_ROUTER_EXAMPLES
+            if PreRoute(text) != expected]
+
+# Thống kê: mỗi request được xử lý bởi nhánh nào ('rule' hoặc 'llm') và mất bao lâu
+_router_lock = threading.Lock()
+_router_stats = {
+    "rule": {"count": 0, "latencies": deque(maxlen=500)},
+    "cache": {"count": 0, "latencies": deque(maxlen=500)},
+    "llm": {"count": 0, "latencies": deque(maxlen=500)},
+}
+
+def _record_route(route: str, elapsed: float):
+    with _router_lock:
+        _router_stats[route]["count"] += 1
+        _router_stats[route]["latencies"].append(elapsed)
+
+def get_router_stats():
+    """Số request theo từng nhánh, tỉ lệ không cần gọi Cohere và p50 (ms)."""
+    with _router_lock:
+        snapshot = {
+            route: (s["count"], sorted(s["latencies"]))
+            for route, s in _router_stats.items()
+        }
+        all_latencies = sorted(l for s in _router_stats.values() for l in s["latencies"])
+
+    def p50(values):
+        return round(values[len(values) // 2] * 1000, 1) if values else None
+
+    total = sum(count for count, _ in snapshot.values())
+    return {
+        "total": total,
+        "hit_rate": round((snapshot["rule"][0] + snapshot["cache"][0]) / total, 3) if total else 0.0,
+        "p50_ms": p50(all_latencies),
+        "routes": {
+            route: {"count": count, "p50_ms": p50(latencies)}
+            for route, (count, latencies) in snapshot.items()
+        },
+        "cache": intent_cache.stats(),
+    }
+
+# === 5. CACHE PHÂN LOẠI (LƯU XUỐNG ĐĨA) ===
+# Người dùng lặp lại cùng một câu lệnh cả ngày ("mở zalo", "mấy giờ rồi"...).
+# Kết quả phân loại của Cohere được cache theo câu đã chuẩn hóa:
+# LRU trong RAM + SQLite trên đĩa (giữ được qua các lần khởi động lại server).
+INTENT_CACHE_PATH = os.path.join(project_root, "Data", "IntentCache.db")
+INTENT_CACHE_MAX_SIZE = int(os.getenv("INTENT_CACHE_MAX_SIZE", "2000"))
+INTENT_CACHE_TTL = int(os.getenv("INTENT_CACHE_TTL", str(7 * 24 * 3600)))
+
+def normalize_utterance(text: str) -> str:
+    """Chuẩn hóa câu nói để dùng làm khóa cache: chữ thường, gộp khoảng trắng, bỏ dấu câu cuối."""
+    text = re.sub(r"\s+", " ", (text or "").lower()).strip()
+    return text.rstrip(" .!?…")
+
+def classifier_fingerprint() -> str:
+    """Hash của preamble/funcs/ChatHistory/model: đổi prompt là cache cũ tự mất hiệu lực."""
+    raw = json.dumps([COHERE_MODEL, preamble, funcs, ChatHistory], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+class IntentCache:
+    def __init__(self, path, max_size=2000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fingerprint = classifier_fingerprint()
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (tasks, expires)
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS intent_cache ("
+                " fingerprint TEXT, utterance TEXT, tasks TEXT, expires REAL,"
+                " PRIMARY KEY (fingerprint, utterance))"
+            )
+            # Dọn bản ghi của preamble/funcs cũ và bản ghi đã hết hạn
+            self.conn.execute(
+                "DELETE FROM intent_cache WHERE fingerprint != ? OR expires < ?",
+                (self.fingerprint, time.time())
+            )
+            self.conn.commit()
+            self._warm_up()
+        except Exception as e:
+            print(f"⚠️ [IntentCache] Không mở được SQLite, chỉ cache trong RAM: {e}")
+            self.conn = None
+
+    def _warm_up(self):
+        rows = self.conn.execute(
+            "SELECT utterance, tasks, expires FROM intent_cache"
+            " WHERE fingerprint = ? ORDER BY expires DESC LIMIT ?",
+            (self.fingerprint, self.max_size)
+        ).fetchall()
+        for utterance, tasks, expires in reversed(rows):
+            self.memory[utterance] = (json.loads(tasks), expires)
+
+    def get(self, prompt: str):
+        key = normalize_utterance(prompt)
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item and item[1] > now:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return list(item[0])
+            if item:
+                del self.memory[key]
+
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT tasks, expires FROM intent_cache WHERE fingerprint = ? AND utterance = ?",
+                    (self.fingerprint, key)
+                ).fetchone()
+                if row and row[1] > now:
+                    tasks = json.loads(row[0])
+                    self._remember(key, tasks, row[1])
+                    self.hits += 1
+                    return list(tasks)
+
+            self.misses += 1
+            return None
+
+    def put(self, prompt: str, tasks: list):
+        key = normalize_utterance(prompt)
+        if not key or not tasks:
+            return
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, tasks, expires)
+            if self.conn is not None:
+                try:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO intent_cache VALUES (?, ?, ?, ?)",
+                        (self.fingerprint, key, json.dumps(tasks, ensure_ascii=False), expires)
+                    )
+                    self.conn.commit()
+                except Exception as e:
+                    print(f"⚠️ [IntentCache] Lỗi ghi SQLite: {e}")
+
+    def _remember(self, key, tasks, expires):
+        self.memory[key] = (list(tasks), expires)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.memory),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "fingerprint": self.fingerprint,
+            }
+
+intent_cache = IntentCache(INTENT_CACHE_PATH, INTENT_CACHE_MAX_SIZE, INTENT_CACHE_TTL)
+
+# Phân loại bằng Cohere (dùng khi PreRoute không chắc chắn)
+def ClassifyWithLLM(prompt: str):
+    """Gọi Cohere để phân loại và trả về list các nhiệm vụ đã được lọc."""
     
     # (Code gọi API Cohere - ĐÃ SỬA LỖI)
     try:
         # --- PHẦN SỬA LỖI ---
         # 1. Đổi co.chat_stream() thành co.chat() 
         #    (Hàm chat_stream đã bị gỡ bỏ ở thư viện Cohere v5)
-        response = co.chat(
-            model='command-nightly', 
-            message=prompt, 
-            temperature=0.7, 
-            chat_history=ChatHistory, 
-            prompt_truncation='OFF', 
-            connectors=[], 
-            preamble=preamble 
-            # Bỏ stream=True vì code của bạn không cần stream
-        )
+        with timed("cohere_classify"):
+            response = co.chat(
+                model=COHERE_MODEL, 
+                message=prompt, 
+                temperature=0.7, 
+                chat_history=ChatHistory, 
+                prompt_truncation='OFF', 
+                connectors=[], 
+                preamble=preamble 
+                # Bỏ stream=True vì code của bạn không cần stream
+            )
 
         # 2. Lấy text trực tiếp từ response, không cần vòng lặp for
         Response_str = response.text
@@ -156,11 +447,44 @@ def FirstLayerLLM(prompt: str = "test"):
 
     except Exception as e:
         print(f"❌ Lỗi khi gọi Cohere API: {e}")
-        return [f"chung Lỗi khi phân loại lệnh: {e}"]
+        return [f"{LLM_ERROR_TASK}: {e}"]
+
+
+# Define the main function for decision-making on queries.
+def FirstLayerLLM(prompt: str = "test"):
+    """
+    Hàm này nhận prompt (text từ STT), phân loại (luật trước, Cohere sau)
+    và trả về một list các nhiệm vụ đã được lọc.
+    Ví dụ: ['mở facebook', 'chung thời tiết hôm nay']
+    """
+    start = time.perf_counter()
+    tasks = PreRoute(prompt)
+    route = "rule"
+    if not tasks:
+        tasks = intent_cache.get(prompt)
+        route = "cache"
+    if not tasks:
+        tasks = ClassifyWithLLM(prompt)
+        route = "llm"
+        if not tasks[0].startswith(LLM_ERROR_TASK):
+            intent_cache.put(prompt, tasks)
+
+    elapsed = time.perf_counter() - start
+    _record_route(route, elapsed)
+    observe_stage(f"first_layer_{route}", elapsed)
+    safe_print(f"🧭 [Router] {route} ({elapsed * 1000:.0f} ms): {tasks}")
+    return tasks
     
 
 # Entry point for the script (Dùng để test)
 if __name__ == '__main__':
+    if "--check-rules" in sys.argv:
+        sai = check_pre_router()
+        for text, expected, actual in sai:
+            print(f"❌ {text!r}: mong đợi {expected}, thực tế {actual}")
+        print(f"PreRoute: {len(PRE_ROUTER_EXAMPLES) - len(sai)}/{len(PRE_ROUTER_EXAMPLES)} ví dụ đúng")
+        sys.exit(1 if sai else 0)
+
     print("🤖 Model.py (ĐÃ NÂNG CẤP) đang chạy để test...")
     print("Nhập câu lệnh của bạn (gõ 'quit' để thoát):")
     while True:
@@ -14,6 +14,8 @@ import google.generativeai as genai
 # --- 1️⃣ KẾT NỐI FIREBASE (THAY THẾ JSON) ---
 from db_connect import db
 from firebase_admin import firestore
+from db_cache import get_user_doc, invalidate_user_doc
+from metrics import timed
 
 # --- 2️⃣ CẤU HÌNH ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -44,15 +46,16 @@ def get_user_profile_engine(user_id):
     if not user_id: return default
     
     try:
-        # Truy cập: users -> [uid]
-        doc = db.collection('users').document(user_id).get()
-        if doc.exists:
-            return doc.to_dict()
+        # Truy cập: users -> [uid] (qua cache dùng chung, TTL ngắn)
+        data = get_user_doc(user_id)
+        if data is not None:
+            return data
         return default
     except Exception as e:
         print(f"❌ Lỗi lấy profile: {e}")
         return default
 
+@timed("firestore_nutrition_profile_save")
 def save_user_profile_engine(user_id, data):
     """Lưu Profile lên Firebase (Thay vì save_json)"""
     if not user_id: return False
@@ -60,11 +63,13 @@ def save_user_profile_engine(user_id, data):
     try:
         # Dùng set với merge=True để chỉ cập nhật các trường thay đổi
         db.collection('users').document(user_id).set(data, merge=True)
+        invalidate_user_doc(user_id)
         return True
     except Exception as e:
         print(f"❌ Lỗi lưu profile: {e}")
         return False
 
+@timed("firestore_nutrition_today")
 def get_today_nutrition_engine(user_id):
     """Lấy dữ liệu dinh dưỡng hôm nay"""
     default_data = { "meals": [], "total_calories": 0, "macros": {"protein": 0, "carbs": 0, "fat": 0}, "water": 0 }
@@ -85,6 +90,7 @@ def get_today_nutrition_engine(user_id):
         print(f"❌ Lỗi lấy log dinh dưỡng: {e}")
         return default_data
 
+@timed("firestore_nutrition_add_meal")
 def add_meal_engine(user_id, meal_data):
     """Thêm món ăn và cộng dồn chỉ số (Logic gốc)"""
     if not user_id: return None
@@ -138,6 +144,7 @@ def add_meal_engine(user_id, meal_data):
         print(f"❌ Lỗi thêm món: {e}")
         return None
 
+@timed("firestore_nutrition_water")
 def update_water_engine(user_id, amount=1):
     """Cập nhật nước (Dùng Atomic Increment cho an toàn)"""
     if not user_id: return 0
@@ -157,6 +164,7 @@ def update_water_engine(user_id, amount=1):
         print(f"❌ Lỗi update nước: {e}")
         return 0
 
+@timed("firestore_nutrition_habits")
 def get_recent_habits_engine(user_id):
     """Lấy thói quen ăn uống gần đây"""
     if not user_id: return "Chưa có dữ liệu."
@@ -208,7 +216,8 @@ def suggest_food_engine(user_profile, remaining_calories, ignore_list=None, pref
     [ {{ "name": "Tên", "calories": 300, "protein": 10, "carbs": 20, "fat": 5, "icon": "🍜", "desc": "Mô tả ngắn lý do chọn" }} ]
     """
     try:
-        res = model.generate_content(prompt)
+        with timed("gemini_nutrition"):
+            res = model.generate_content(prompt)
         data = json.loads(clean_json_response(res.text))
         return data.get("suggestions", data) if isinstance(data, dict) else data
     except: return []
@@ -231,7 +240,8 @@ def calculate_recommended_calories_engine(incoming_data, user_id=None):
         Input: {age} tuổi, {gender}, {h}cm, {w}kg, activity: {act}, goal: {goal}.
         Output JSON: {{ "calories": 2000, "reason": "Giải thích ngắn" }}
         """
-        res = model.generate_content(prompt)
+        with timed("gemini_nutrition"):
+            res = model.generate_content(prompt)
         return json.loads(clean_json_response(res.text))
     except: return { "calories": 2000 }
 
@@ -248,7 +258,8 @@ def estimate_nutrition_from_name_engine(food_name):
     }}
     """
     try:
-        res = model.generate_content(prompt)
+        with timed("gemini_nutrition"):
+            res = model.generate_content(prompt)
         return json.loads(clean_json_response(res.text))
     except: return { "name": food_name, "calories": 0 }
 
@@ -264,7 +275,8 @@ def analyze_food_image_engine(image_path: str):
     """
     try:
         with Image.open(image_path) as img:
-            res = model.generate_content([prompt, img])
+            with timed("gemini_nutrition"):
+                res = model.generate_content([prompt, img])
             data = json.loads(clean_json_response(res.text))
             
             if not data.get("is_food", True): return { "error": data.get("error") }
@@ -351,7 +363,8 @@ def parse_voice_command_engine(text: str, user_id: str = None):
     
     try:
         print(f"🗣️ [AI Calculating] Input: {text}")
-        response = model.generate_content(prompt)
+        with timed("gemini_nutrition"):
+            response = model.generate_content(prompt)
         return json.loads(clean_json_response(response.text))
     except Exception as e:
         print(f"❌ Lỗi Voice AI: {e}")
@@ -1,8 +1,15 @@
 # Backend/RealTimeSearch_engine.py
 import os
 import time
+import threading
 import requests
+from http_client import http_get
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ttl_cache import TTLCache, BackgroundRefresher
+from disk_cache import disk_cache
+from keyword_router import KeywordRouter
+from metrics import timed
 
 # -------------------------
 # Load .env
@@ -40,150 +47,246 @@ except:
     DDGS = None
 
 # -------------------------
-# Simple cache (Giữ nguyên)
+# Cache dùng chung (TTL + LRU + gộp request trùng)
 # -------------------------
-_cache = {}
+# Giá vàng / tỷ giá / cổ phiếu: hết hạn vẫn được phục vụ bản cũ (tối đa stale_ttl)
+# trong lúc tải lại nền; các key được hỏi nhiều được refresher làm mới trước khi hết hạn.
+_cache = TTLCache(max_size=1000, default_ttl=300, stale_ttl=1800, name="realtime")
+_refresher = BackgroundRefresher(_cache, interval=10, top_k=20).start()
 
 def cache_set(key: str, value, ttl: int = 300):
-    _cache[key] = {"value": value, "expires": time.time() + ttl}
+    _cache.set(key, value, ttl)
 
 def cache_get(key: str):
-    item = _cache.get(key)
-    if not item: return None
-    if time.time() > item["expires"]:
-        del _cache[key]
-        return None
-    return item["value"]
+    return _cache.get(key)
+
+def _khong_loi(value):
+    """Chỉ cache kết quả thành công (các hàm fetch trả về {'error': ...} khi lỗi)."""
+    return not (isinstance(value, dict) and "error" in value)
+
+def get_cache_stats():
+    return {**_cache.stats(), "disk": disk_cache.stats()}
+
+# -------------------------
+# Fan-out nhiều nguồn song song (có deadline)
+# -------------------------
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "6"))
+_search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="search")
+_PENDING = object()
+
+def _co_du_lieu(value):
+    """Kết quả dùng được: không rỗng và không phải dict lỗi."""
+    return bool(value) and _khong_loi(value)
+
+def fan_out(sources, timeout=None, usable=_co_du_lieu):
+    """
+    Gọi đồng thời các nguồn [(tên, hàm), ...] (xếp theo thứ tự ưu tiên) trong 1 deadline.
+    Nguồn ưu tiên cao nhất có kết quả dùng được sẽ thắng ngay khi mọi nguồn đứng trước nó
+    đã thất bại; hết deadline thì lấy nguồn tốt nhất đã về. Các nguồn thua bị hủy/bỏ qua.
+    Trả về (tên nguồn, kết quả) hoặc (None, None).
+    """
+    timeout = SEARCH_DEADLINE if timeout is None else timeout
+    futures = [_search_pool.submit(fn) for _, fn in sources]
+    results = [_PENDING] * len(futures)
+    deadline = time.time() + timeout
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+            if not done:
+                break  # hết deadline
+            for f in done:
+                try:
+                    results[futures.index(f)] = f.result()
+                except Exception as e:
+                    results[futures.index(f)] = {"error": str(e)}
+            for (name, _), result in zip(sources, results):
+                if result is _PENDING:
+                    break  # nguồn ưu tiên cao hơn chưa về, chờ tiếp
+                if usable(result):
+                    return name, result
+
+        for (name, _), result in zip(sources, results):
+            if result is not _PENDING and usable(result):
+                return name, result
+        return None, None
+    finally:
+        # Request HTTP đang chạy không dừng giữa chừng được, nhưng ta không chờ chúng nữa
+        for f in futures:
+            f.cancel()
 
 # -------------------------
 # API Functions
 # -------------------------
 
+# Tỷ giá: tải 1 bảng đầy đủ theo 1 đồng tiền gốc mỗi chu kỳ làm mới,
+# mọi cặp (USD/VND, EUR/VND, VND/USD, ...) được tính chéo từ bảng trong RAM.
+RATES_BASE = "USD"
+RATES_TTL = int(os.getenv("RATES_TTL", "3600"))
+
+def fetch_rates_table():
+    """Bảng tỷ giá {'base', 'rates', 'timestamp'} theo RATES_BASE (hoặc dict lỗi)."""
+    def fetch():
+        url = f"https://api.exchangerate.host/latest?base={RATES_BASE}"
+        try:
+            r = http_get(url, timeout=8)
+            r.raise_for_status()
+            data = r.json()
+            rates = data.get("rates") or {}
+            if rates:
+                rates[RATES_BASE] = 1.0
+                return {"base": RATES_BASE, "rates": rates, "timestamp": data.get("date"), "fetched_at": time.time()}
+            return {"error": "Không lấy được tỷ giá."}
+        except Exception as e:
+            return {"error": f"Lỗi exchangerate.host: {e}"}
+    def load():
+        # Bảng trên đĩa chỉ dùng khi còn mới (chủ yếu lúc vừa restart). Lần làm mới nền chạy
+        # gần lúc hết hạn nên bản đĩa đã cũ quá nửa TTL -> tải mới, không quay vòng lại bản cũ.
+        table = disk_cache.get("fx", f"table:{RATES_BASE}")
+        if table and time.time() - table.get("fetched_at", 0) < RATES_TTL / 2:
+            return table
+        table = fetch()
+        if _khong_loi(table):
+            disk_cache.set("fx", f"table:{RATES_BASE}", table, ttl=RATES_TTL)
+        return table
+    def remaining_ttl(table):
+        # RAM chỉ giữ phần TTL còn lại tính từ lúc tải, không cấp thêm 1 TTL mới cho bản đĩa
+        return max(1, RATES_TTL - (time.time() - table.get("fetched_at", time.time())))
+    return _cache.get_or_load(f"rates:{RATES_BASE}", load, ttl=remaining_ttl, cacheable=_khong_loi, stale_ok=True)
+
 def fetch_exchange_rate(base="USD", target="VND"):
-    key = f"rate:{base}:{target}"
-    cached = cache_get(key)
-    if cached: return cached
-    url = f"https://api.exchangerate.host/latest?base={base}&symbols={target}"
-    try:
-        r = requests.get(url, timeout=8)
-        r.raise_for_status()
-        data = r.json()
-        rate = data.get("rates", {}).get(target)
-        if rate:
-            res = {"base": base, "target": target, "rate": rate, "timestamp": data.get("date")}
-            cache_set(key, res, 300)
-            return res
-        return {"error": "Không lấy được tỷ giá."}
-    except Exception as e:
-        return {"error": f"Lỗi exchangerate.host: {e}"}
+    table = fetch_rates_table()
+    if "error" in table:
+        return table
+    base, target = base.upper(), target.upper()
+    rates = table["rates"]
+    if not rates.get(base) or not rates.get(target):
+        return {"error": f"Không có tỷ giá cho {base}/{target}."}
+    # Tỷ giá chéo: 1 base = rates[target] / rates[base] target
+    return {"base": base, "target": target, "rate": rates[target] / rates[base], "timestamp": table["timestamp"]}
+
+def _fetch_wikipedia_lang(lang, title, sentences):
+    def load():
+        try:
+            url = f"https://{lang}.wikipedia.org/api/rest_v1/page/summary/{requests.utils.requote_uri(title)}"
+            r = http_get(url, timeout=6)
+            r.raise_for_status()
+            extract = r.json().get("extract")
+            if extract:
+                return ". ".join(extract.split(". ")[:sentences]).strip()
+            return {"error": "Không có dữ liệu Wikipedia."}
+        except Exception as e:
+            return {"error": f"Lỗi Wikipedia ({lang}): {e}"}
+    # Tóm tắt Wikipedia hầu như không đổi: lưu đĩa để restart không phải tải lại
+    return disk_cache.get_or_load("wiki", f"{lang}:{title}:{sentences}", load, cacheable=_khong_loi)
 
 def fetch_wikipedia_summary(title, sentences=3):
-    key = f"wiki:{title}:{sentences}"
-    cached = cache_get(key)
-    if cached: return cached
-    try:
-        url_vi = f"https://vi.wikipedia.org/api/rest_v1/page/summary/{requests.utils.requote_uri(title)}"
-        r = requests.get(url_vi, timeout=6)
-        if r.status_code == 404:
-            url_en = f"https://en.wikipedia.org/api/rest_v1/page/summary/{requests.utils.requote_uri(title)}"
-            r = requests.get(url_en, timeout=6)
-        r.raise_for_status()
-        data = r.json()
-        extract = data.get("extract")
-        if extract:
-            short = ". ".join(extract.split(". ")[:sentences]).strip()
-            cache_set(key, short, 3600)
-            return short
-        return {"error": "Không có dữ liệu Wikipedia."}
-    except Exception as e:
-        return {"error": f"Lỗi Wikipedia: {e}"}
+    def load():
+        # Hỏi vi + en cùng lúc; ưu tiên bản tiếng Việt nếu có
+        _, result = fan_out([
+            ("vi", lambda: _fetch_wikipedia_lang("vi", title, sentences)),
+            ("en", lambda: _fetch_wikipedia_lang("en", title, sentences)),
+        ])
+        return result if result is not None else {"error": "Không có dữ liệu Wikipedia."}
+    return _cache.get_or_load(f"wiki:{title}:{sentences}", load, ttl=3600, cacheable=_khong_loi)
 
 def fetch_gold_price(currency="VND"):
-    key = f"gold:{currency}"
-    cached = cache_get(key)
-    if cached: return cached
     if not GOLD_API_KEY: return {"error": "Thiếu GoldAPIKey trong .env"}
-    url = f"https://www.goldapi.io/api/XAU/{currency}"
-    headers = {"x-access-token": GOLD_API_KEY, "Content-Type": "application/json"}
-    try:
-        r = requests.get(url, headers=headers, timeout=8)
-        r.raise_for_status()
-        data = r.json()
-        price = data.get("price") or data.get("ask") or data.get("bid")
-        res = {"currency": currency, "price": price, "raw": data}
-        cache_set(key, res, 600)
-        return res
-    except Exception as e:
-        return {"error": f"Lỗi GoldAPI: {e}"}
+    def load():
+        url = f"https://www.goldapi.io/api/XAU/{currency}"
+        headers = {"x-access-token": GOLD_API_KEY, "Content-Type": "application/json"}
+        try:
+            r = http_get(url, headers=headers, timeout=8)
+            r.raise_for_status()
+            data = r.json()
+            price = data.get("price") or data.get("ask") or data.get("bid")
+            return {"currency": currency, "price": price, "raw": data}
+        except Exception as e:
+            return {"error": f"Lỗi GoldAPI: {e}"}
+    return _cache.get_or_load(f"gold:{currency}", load, ttl=600, cacheable=_khong_loi, stale_ok=True)
 
 def fetch_news(query, page_size=5):
-    key = f"news:{query}:{page_size}"
-    cached = cache_get(key)
-    if cached: return cached
     if not NEWSDATA_API_KEY: return {"error": "Thiếu NewsDataApiKey trong .env"}
-    url = "https://newsdata.io/api/1/news"
-    params = {"apikey": NEWSDATA_API_KEY, "q": query, "language": "vi,en", "page_size": page_size}
-    try:
-        r = requests.get(url, params=params, timeout=8)
-        r.raise_for_status()
-        data = r.json()
-        articles = data.get("results", [])
-        summary = [{"title": a.get("title"), "description": a.get("description"), "link": a.get("link")} for a in articles]
-        cache_set(key, summary, 300)
-        return summary
-    except Exception as e:
-        return {"error": f"Lỗi NewsData.io: {e}"}
+    def load():
+        url = "https://newsdata.io/api/1/news"
+        params = {"apikey": NEWSDATA_API_KEY, "q": query, "language": "vi,en", "page_size": page_size}
+        try:
+            r = http_get(url, params=params, timeout=8)
+            r.raise_for_status()
+            data = r.json()
+            articles = data.get("results", [])
+            return [{"title": a.get("title"), "description": a.get("description"), "link": a.get("link")} for a in articles]
+        except Exception as e:
+            return {"error": f"Lỗi NewsData.io: {e}"}
+    return _cache.get_or_load(f"news:{query}:{page_size}", load, ttl=300, cacheable=_khong_loi)
+
+# Mỗi luồng giữ 1 phiên DDGS riêng (DDGS không an toàn khi dùng chung giữa nhiều luồng)
+# để tái sử dụng kết nối thay vì bắt tay TLS lại mỗi lần tìm kiếm
+_ddgs_local = threading.local()
+
+def _get_ddgs():
+    ddgs = getattr(_ddgs_local, "client", None)
+    if ddgs is None:
+        ddgs = _ddgs_local.client = DDGS()
+    return ddgs
 
 def duckduckgo_search_snippets(query, num_results=3):
     if DDGS is None: return None
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, region='vn-vi', max_results=num_results))
+        results = list(_get_ddgs().text(query, region='vn-vi', max_results=num_results))
         snippets = [r.get("body") for r in results if r.get("body")]
         return "\n\n".join(snippets) if snippets else None
     except:
+        _ddgs_local.client = None  # phiên lỗi thì bỏ, lần sau tạo lại
         return None
 
 def fetch_stock_price(symbol):
-    key = f"stock:{symbol.upper()}"
-    cached = cache_get(key)
-    if cached: return cached
     if not ALPHAVANTAGE_KEY: return {"error": "Thiếu ALPHAVANTAGE_KEY trong .env"}
-    url = "https://www.alphavantage.co/query"
-    params = {"function": "GLOBAL_QUOTE", "symbol": symbol, "apikey": ALPHAVANTAGE_KEY}
-    try:
-        r = requests.get(url, params=params, timeout=8)
-        r.raise_for_status()
-        data = r.json().get("Global Quote", {})
-        if not data: return {"error": f"Không tìm thấy thông tin cho {symbol}"}
-        stock = {
-            "symbol": symbol,
-            "price": float(data.get("05. price", 0)),
-            "change": float(data.get("09. change", 0)),
-            "change_percent": data.get("10. change percent", ""),
-            "volume": int(data.get("06. volume", 0))
-        }
-        cache_set(key, stock, 120)
-        return stock
-    except Exception as e:
-        return {"error": f"Lỗi AlphaVantage: {e}"}
+    def load():
+        url = "https://www.alphavantage.co/query"
+        params = {"function": "GLOBAL_QUOTE", "symbol": symbol, "apikey": ALPHAVANTAGE_KEY}
+        try:
+            r = http_get(url, params=params, timeout=8)
+            r.raise_for_status()
+            data = r.json().get("Global Quote", {})
+            if not data: return {"error": f"Không tìm thấy thông tin cho {symbol}"}
+            return {
+                "symbol": symbol,
+                "price": float(data.get("05. price", 0)),
+                "change": float(data.get("09. change", 0)),
+                "change_percent": data.get("10. change percent", ""),
+                "volume": int(data.get("06. volume", 0))
+            }
+        except Exception as e:
+            return {"error": f"Lỗi AlphaVantage: {e}"}
+    return _cache.get_or_load(f"stock:{symbol.upper()}", load, ttl=120, cacheable=_khong_loi, stale_ok=True)
 
 # -------------------------
 # Intent Detector
 # -------------------------
+# Từ khoá -> intent kèm trọng số; cụm dài/đặc trưng nặng hơn từ chung chung
+# ("giá vàng" thắng "giá", "tỷ giá usd" không bị hiểu là cổ phiếu).
+# Thứ tự intent là thứ tự ưu tiên khi hoà điểm (giống chuỗi if cũ).
+INTENT_ROUTER = KeywordRouter({
+    "weather": {"thời tiết": 3, "mưa": 1, "nắng": 1, "weather": 2, "nhiệt độ": 2},
+    "exchange_rate": {"tỷ giá": 3, "tỉ giá": 3, "exchange": 2, "usd": 2, "vnd": 1, "euro": 2},
+    "gold_price": {"giá vàng": 3, "vàng": 1.5, "xau": 2},
+    "stock": {"cổ phiếu": 3, "chứng khoán": 3, "stock": 2, "giá": 0.5, "mã": 0.5},
+    "wiki": {"ai là": 2, "là ai": 2, "tiểu sử": 3, "who is": 2},
+    "news": {"tin tức": 3, "news": 2, "breaking": 2},
+})
+
+def detect_intents(text):
+    """Mọi intent khớp kèm điểm, giảm dần: [('gold_price', 3.0), ...]."""
+    return INTENT_ROUTER.match(text)
+
 def detect_intent(text):
-    t = text.lower()
-    if any(k in t for k in ["thời tiết", "mưa", "nắng", "weather", "nhiệt độ"]): return "weather"
-    if any(k in t for k in ["tỷ giá", "exchange", "usd", "vnd", "euro"]): return "exchange_rate"
-    if any(k in t for k in ["giá vàng", "vàng", "xau"]): return "gold_price"
-    if any(k in t for k in ["cổ phiếu", "chứng khoán", "stock", "giá", "mã"]): return "stock"
-    if any(k in t for k in ["ai là", "là ai", "tiểu sử", "who is"]): return "wiki"
-    if any(k in t for k in ["tin tức", "news", "breaking"]): return "news"
-    return "general"
+    return INTENT_ROUTER.best(text, "general")
 
 # -------------------------
 # Main Engine
 # -------------------------
+@timed("realtime_search")
 def RealtimeSearchEngine(prompt, user_id=None):
     if not prompt: return "Vui lòng nhập câu hỏi."
     intent = detect_intent(prompt)
@@ -223,18 +326,23 @@ def RealtimeSearchEngine(prompt, user_id=None):
 
         if intent == "news":
             query = prompt.replace("tin tức", "").strip() or "news"
-            data = fetch_news(query)
-            if isinstance(data, dict) and "error" in data:
-                snip = duckduckgo_search_snippets(prompt)
-                # 👇 SỬA LỖI: Thêm user_id vào cả 2 chỗ gọi ChatBot
-                return ChatBot(f"Tóm tắt tin:\n{snip}", user_id=user_id) if snip else ChatBot(prompt, user_id=user_id)
-            
-            text = "\n".join([f"- {a['title']}. {a['description']} [{a['link']}]" for a in data[:5]])
-            # 👇 SỬA LỖI: Thêm user_id vào đây nữa
-            return ChatBot(f"Tóm tắt 3 câu:\n{text}", user_id=user_id)
-
-        # fallback
-        snip = duckduckgo_search_snippets(prompt)
+            # NewsData và DuckDuckGo chạy song song, ưu tiên NewsData
+            source, data = fan_out([
+                ("newsdata", lambda: fetch_news(query)),
+                ("duckduckgo", lambda: duckduckgo_search_snippets(prompt)),
+            ])
+            if source == "newsdata":
+                text = "\n".join([f"- {a['title']}. {a['description']} [{a['link']}]" for a in data[:5]])
+                # 👇 SỬA LỖI: Thêm user_id vào đây nữa
+                return ChatBot(f"Tóm tắt 3 câu:\n{text}", user_id=user_id)
+            # 👇 SỬA LỖI: Thêm user_id vào cả 2 chỗ gọi ChatBot
+            return ChatBot(f"Tóm tắt tin:\n{data}", user_id=user_id) if data else ChatBot(prompt, user_id=user_id)
+
+        # fallback: chỉ DuckDuckGo (qua fan_out để có deadline). Không tra Wikipedia bằng
+        # nguyên câu hỏi: câu đầy đủ hầu như không phải tên trang nên chỉ tốn 1 lượt 404.
+        _, snip = fan_out([
+            ("duckduckgo", lambda: duckduckgo_search_snippets(prompt)),
+        ])
         if snip:
             enhanced_prompt = (
                 f"[THÔNG TIN TÌM KIẾM - KHÔNG HIỂN THỊ CHO NGƯỜI DÙNG]\n"
@@ -1,7 +1,12 @@
 # Backend/RealtimeTools.py
 import os
+import time
 import datetime
-import requests
+import threading
+from http_client import http_get
+from disk_cache import disk_cache
+from ttl_cache import TTLCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 # --- Nạp API Key ---
@@ -23,48 +28,139 @@ def LayThongTinThoiGianThuc():
     day_name = days_vi[now.weekday()]
     return now.strftime(f"Hôm nay là {day_name}, ngày %d tháng %m năm %Y, lúc %H:%M:%S.")
 
+def LayViTriTheoIP():
+    """Xác định vị trí thiết bị qua IP. Trả về (lat, lon, city) hoặc None."""
+    res = http_get("https://ipinfo.io/json", timeout=5)
+    data = res.json()
+    loc = data.get("loc", "")
+    city = data.get("city", "Không rõ")
+    if not loc: return None
+    lat, lon = loc.split(",")
+    return lat, lon, city
+
+def _TaiThongTinThoiTiet(vi_tri):
+    """Gọi OpenWeatherMap cho vị trí đã biết. Trả về (chuỗi mô tả, thành công?)."""
+    lat, lon, city = vi_tri
+    url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={WEATHER_API_KEY}&units=metric&lang=vi"
+    weather_res = http_get(url, timeout=5)
+    weather_data = weather_res.json()
+
+    if weather_data.get("cod") != 200:
+         msg = weather_data.get("message", "Không rõ lỗi")
+         return f"⚠️ Lỗi OpenWeatherMap: {msg} (thành phố: {city})", False
+
+    desc = weather_data["weather"][0]["description"]
+    main = weather_data["weather"][0]["main"]
+    temp = weather_data["main"]["temp"]
+    feels = weather_data["main"].get("feels_like", temp)
+    hum = weather_data["main"]["humidity"]
+
+    raining = "mưa" in desc.lower() or "rain" in main.lower()
+    if raining:
+        rain_text = "☔ Có vẻ trời đang mưa, bạn ra ngoài nhớ mang theo ô nhé!"
+    else:
+        rain_text = "🌤️ Trời không mưa, thời tiết khá đẹp."
+
+    return (
+        f"Thời tiết tại {city} hiện tại: {desc}, nhiệt độ là {temp:.1f}°C "
+        f"(cảm giác như {feels:.1f}°C), độ ẩm {hum}%. {rain_text}"
+    ), True
+
+class WeatherContextProvider:
+    """
+    Cache thông tin thời tiết dùng chung (ChatBot chèn vào mọi prompt).
+    - Vị trí theo IP: cache lâu (mặc định 6 giờ).
+    - Chuỗi thời tiết: cache ngắn (mặc định 10 phút), có thread chạy ngầm làm mới trước khi hết hạn.
+    """
+    def __init__(self, geo_ttl=6 * 3600, weather_ttl=600):
+        self.geo_ttl = geo_ttl
+        self.weather_ttl = weather_ttl
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.vi_tri = None
+        self.vi_tri_expires = 0
+        self.thoi_tiet = None
+        self.thoi_tiet_expires = 0
+        self.thread = None
+
+    def _lay_vi_tri(self):
+        with self.lock:
+            if self.vi_tri and time.time() < self.vi_tri_expires:
+                return self.vi_tri
+        vi_tri = LayViTriTheoIP()
+        if vi_tri:
+            with self.lock:
+                self.vi_tri = vi_tri
+                self.vi_tri_expires = time.time() + self.geo_ttl
+        return vi_tri
+
+    def refresh(self, force=True):
+        """Tải lại thời tiết. Chỉ cache kết quả thành công; trả về chuỗi mới nhất (có thể là lỗi)."""
+        with self.refresh_lock:
+            if not force:
+                # Thread khác vừa làm mới xong trong lúc ta chờ lock
+                with self.lock:
+                    if self.thoi_tiet and time.time() < self.thoi_tiet_expires:
+                        return self.thoi_tiet
+            vi_tri = self._lay_vi_tri()
+            if not vi_tri: return "Không thể xác định vị trí thiết bị."
+            text, ok = _TaiThongTinThoiTiet(vi_tri)
+            if ok:
+                with self.lock:
+                    self.thoi_tiet = text
+                    self.thoi_tiet_expires = time.time() + self.weather_ttl
+            return text
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️ [WeatherContext] Lỗi làm mới thời tiết: {e}")
+            # Làm mới ở nửa TTL để cache không bao giờ hết hạn khi đang dùng
+            time.sleep(max(30, self.weather_ttl // 2))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._refresh_loop, daemon=True)
+                self.thread.start()
+
+    def get(self, block=True):
+        """
+        block=True: hết cache thì gọi API ngay (dùng khi người dùng hỏi thời tiết).
+        block=False: không bao giờ chờ mạng, trả về bản cache gần nhất (dùng cho system prompt).
+        """
+        self.start()
+        with self.lock:
+            cached = self.thoi_tiet
+            fresh = cached and time.time() < self.thoi_tiet_expires
+        if fresh or (cached and not block):
+            return cached
+        if not block:
+            return "Chưa có thông tin thời tiết."
+        return self.refresh(force=False)
+
+weather_context = WeatherContextProvider()
+
 def LayThongTinThoiTiet():
-    """Lấy thông tin thời tiết hiện tại dựa vào IP thiết bị (Code cũ)."""
+    """Lấy thông tin thời tiết hiện tại dựa vào IP thiết bị (có cache dùng chung)."""
     if not WEATHER_API_KEY:
         print("❌ Lỗi: Thiếu WeatherAPIKey trong file .env (RealtimeTools)")
         return "⚠️ Xin lỗi, tôi không thể lấy thông tin thời tiết vì thiếu API Key."
 
     try:
-        res = requests.get("https://ipinfo.io/json", timeout=5)
-        data = res.json()
-        loc = data.get("loc", "")
-        city = data.get("city", "Không rõ")
-        if not loc: return "Không thể xác định vị trí thiết bị."
-        lat, lon = loc.split(",")
-
-        url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={WEATHER_API_KEY}&units=metric&lang=vi"
-        weather_res = requests.get(url, timeout=5)
-        weather_data = weather_res.json()
-
-        if weather_data.get("cod") != 200:
-             msg = weather_data.get("message", "Không rõ lỗi")
-             return f"⚠️ Lỗi OpenWeatherMap: {msg} (thành phố: {city})"
-
-        desc = weather_data["weather"][0]["description"]
-        main = weather_data["weather"][0]["main"]
-        temp = weather_data["main"]["temp"]
-        feels = weather_data["main"].get("feels_like", temp)
-        hum = weather_data["main"]["humidity"]
-
-        raining = "mưa" in desc.lower() or "rain" in main.lower()
-        if raining:
-            rain_text = "☔ Có vẻ trời đang mưa, bạn ra ngoài nhớ mang theo ô nhé!"
-        else:
-            rain_text = "🌤️ Trời không mưa, thời tiết khá đẹp."
-
-        return (
-            f"Thời tiết tại {city} hiện tại: {desc}, nhiệt độ là {temp:.1f}°C "
-            f"(cảm giác như {feels:.1f}°C), độ ẩm {hum}%. {rain_text}"
-        )
+        return weather_context.get(block=True)
     except Exception as e:
         print(f"❌ Lỗi nghiêm trọng khi lấy thời tiết: {e}")
         return f"❌ Xin lỗi, đã xảy ra lỗi khi lấy thông tin thời tiết: {e}"
 
+def LayThongTinThoiTietDaCache():
+    """Bản không chặn của LayThongTinThoiTiet: chỉ đọc cache, thread ngầm lo việc làm mới."""
+    if not WEATHER_API_KEY:
+        return "⚠️ Không có thông tin thời tiết (thiếu API Key)."
+    return weather_context.get(block=False)
+
 
 # =========================================================
 # PHẦN THÊM MỚI (CHO UI WEATHER SCREEN - DÙNG OPEN-METEO)
@@ -84,115 +180,247 @@ def convert_wmo_to_owm(code, is_day=True):
     if code in [71, 73, 75, 77, 85, 86]: return f"13{suffix}" # Snow
     return f"02{suffix}"
 
+# =========================================================
+# CACHE CHO GetWeatherJson (/api/weather_data)
+# =========================================================
+# - Toạ độ: cache theo tên thành phố đã chuẩn hoá (RAM + đĩa), vị trí IP của máy cache riêng.
+# - Dự báo: cache theo ô lưới lat/lon đã làm tròn, hết hạn đúng mốc Open-Meteo cập nhật
+#   dữ liệu "current" (15 phút/lần) nên mọi người hỏi cùng 1 thành phố dùng chung 1 lần gọi.
+# - TTLCache.get_or_load gộp các request trùng đang chạy thành 1 lần gọi ra ngoài.
+GEO_TTL = 24 * 3600
+IP_GEO_TTL = 6 * 3600
+GEO_MISS_TTL = 600  # tên không tìm thấy (gõ sai...): nhớ ngắn để không hỏi lại API liên tục
+FORECAST_CADENCE = int(os.getenv("FORECAST_CADENCE", "900"))
+GRID_DECIMALS = 1  # ~11km: đủ nhỏ so với độ phân giải mô hình Open-Meteo
+_weather_cache = TTLCache(max_size=500, default_ttl=FORECAST_CADENCE, name="weather")
+
+def _ChuanHoaTenThanhPho(city_name):
+    return " ".join(city_name.lower().split())
+
+def _GeocodeThanhPho(city_name):
+    """Tên thành phố -> {'lat', 'lon', 'name'} hoặc None. Toạ độ gần như không đổi nên lưu cache đĩa."""
+    key = _ChuanHoaTenThanhPho(city_name)
+    def fetch():
+        geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city_name}&limit=1&appid={WEATHER_API_KEY}"
+        geo_res = http_get(geo_url, timeout=5).json()
+        if not geo_res:
+            return {"not_found": True}
+        return {"lat": geo_res[0]['lat'], "lon": geo_res[0]['lon'], "name": geo_res[0]['name']}
+    def load():
+        # Lỗi mạng thì ném exception (không cache); "không tìm thấy" được cache với TTL ngắn
+        geo = disk_cache.get("geo", key)
+        if geo is None:
+            geo = fetch()
+            disk_cache.set("geo", key, geo, ttl=GEO_MISS_TTL if geo.get("not_found") else None)
+        return geo
+    geo = _weather_cache.get_or_load(
+        f"geo:{key}", load, ttl=lambda v: GEO_MISS_TTL if v.get("not_found") else GEO_TTL
+    )
+    return None if geo.get("not_found") else geo
+
+def _ViTriIPDaCache():
+    return _weather_cache.get_or_load("geo:ip", LayViTriTheoIP, ttl=IP_GEO_TTL, cacheable=lambda v: v is not None)
+
+def _OLuoi(lat, lon):
+    return round(float(lat), GRID_DECIMALS), round(float(lon), GRID_DECIMALS)
+
+def _ThoiGianDenLanCapNhat():
+    """Số giây tới mốc cập nhật kế tiếp của Open-Meteo (tối thiểu 60s)."""
+    return max(60, FORECAST_CADENCE - int(time.time()) % FORECAST_CADENCE)
+
+def _UrlOpenMeteo(lats, lons):
+    return (
+        f"https://api.open-meteo.com/v1/forecast?"
+        f"latitude={lats}&longitude={lons}&"
+        f"current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&"
+        f"hourly=temperature_2m,weather_code&"
+        f"timezone=auto&forecast_days=2"
+    )
+
+def _TaiDuBao(lat, lon):
+    """Dữ liệu Open-Meteo thô cho ô lưới chứa (lat, lon), dùng chung qua cache."""
+    cell = _OLuoi(lat, lon)
+    def load():
+        return http_get(_UrlOpenMeteo(*cell), timeout=5).json()
+    return _weather_cache.get_or_load(
+        f"forecast:{cell[0]}:{cell[1]}", load,
+        ttl=_ThoiGianDenLanCapNhat(), cacheable=lambda res: "error" not in res
+    )
+
+def _XacDinhViTri(city_name):
+    """Trả về (lat, lon, display_name) hoặc dict lỗi."""
+    lat, lon, display_name = None, None, ""
+
+    if not city_name or city_name in ["Vị trí hiện tại", ""]:
+        # Lấy theo IP (giống logic cũ)
+        try:
+            vi_tri = _ViTriIPDaCache()
+            if vi_tri:
+                lat, lon = float(vi_tri[0]), float(vi_tri[1])
+                # Lấy tên thành phố từ IP Info hoặc OpenWeatherMap Reverse Geo nếu cần chuẩn xác hơn
+                # Ở đây dùng tạm IP Info city hoặc fallback
+                display_name = vi_tri[2] or "Vị trí của bạn"
+        except:
+            return {"error": "Lỗi định vị IP"}
+    else:
+        # Tìm theo tên thành phố (Dùng Key cũ của bạn để tìm tọa độ)
+        if not WEATHER_API_KEY: return {"error": "Thiếu API Key để tìm thành phố"}
+
+        try:
+            geo = _GeocodeThanhPho(city_name)
+            if geo:
+                lat = geo['lat']
+                lon = geo['lon']
+                display_name = geo['name'] # Tên chuẩn quốc tế
+            else:
+                return {"error": f"Không tìm thấy: {city_name}"}
+        except:
+            return {"error": "Lỗi kết nối Geocoding"}
+
+    if lat is None or lon is None:
+        return {"error": "Không xác định được tọa độ"}
+    return lat, lon, display_name
+
+def _DinhDangThoiTiet(res, display_name):
+    """Dữ liệu Open-Meteo thô -> JSON cho UI."""
+    current = res["current"]
+    hourly = res["hourly"]
+
+    now_hour = datetime.datetime.now().hour
+    is_day = 6 <= now_hour <= 18
+    icon_code_current = convert_wmo_to_owm(current["weather_code"], is_day)
+
+    # Map code sang tiếng Việt
+    weather_desc = "Có mây"
+    c = current["weather_code"]
+    if c == 0: weather_desc = "Trời quang"
+    elif c in [1, 2, 3]: weather_desc = "Nhiều mây"
+    elif c in [61, 63, 65, 80, 81, 82]: weather_desc = "Mưa"
+    elif c >= 95: weather_desc = "Dông bão"
+
+    # Xử lý Hourly (lấy 12 mốc tiếp theo)
+    hourly_data = []
+    current_iso = datetime.datetime.now().strftime("%Y-%m-%dT%H:00")
+    try:
+        start_index = 0
+        for i, t in enumerate(hourly["time"]):
+            if t >= current_iso:
+                start_index = i
+                break
+
+        for i in range(start_index, start_index + 12):
+            if i >= len(hourly["time"]): break
+            raw_time = hourly["time"][i]
+            time_str = raw_time.split("T")[1] # Lấy giờ "14:00"
+
+            h_val = int(time_str.split(":")[0])
+            h_is_day = 6 <= h_val <= 18
+
+            hourly_data.append({
+                "time": time_str,
+                "temp": round(hourly["temperature_2m"][i]),
+                "icon_code": convert_wmo_to_owm(hourly["weather_code"][i], h_is_day)
+            })
+    except: pass
+
+    return {
+        "city": display_name,
+        "temp": round(current["temperature_2m"]),
+        "temp_min": round(min(hourly["temperature_2m"][:24])),
+        "temp_max": round(max(hourly["temperature_2m"][:24])),
+        "desc": weather_desc,
+        "icon_code": icon_code_current,
+        "humidity": f"{current['relative_humidity_2m']}%",
+        "wind_speed": f"{current['wind_speed_10m']} km/h",
+        "pressure": f"{round(current['surface_pressure'])} hPa",
+        "visibility": f"{round(current['visibility'] / 1000, 1)} km",
+        "hourly": hourly_data
+    }
+
 def GetWeatherJson(city_name=None):
     """
     Trả về JSON chi tiết cho UI (bao gồm Hourly Forecast).
     Kết hợp: Geocoding (OpenWeatherMap) + Data (Open-Meteo).
     """
     try:
-        lat, lon = None, None
-        display_name = ""
-
         # 1. Xác định vị trí
-        if not city_name or city_name in ["Vị trí hiện tại", ""]:
-            # Lấy theo IP (giống logic cũ)
-            try:
-                res = requests.get("https://ipinfo.io/json", timeout=5)
-                data = res.json()
-                loc = data.get("loc", "").split(",")
-                if len(loc) == 2:
-                    lat, lon = float(loc[0]), float(loc[1])
-                    # Lấy tên thành phố từ IP Info hoặc OpenWeatherMap Reverse Geo nếu cần chuẩn xác hơn
-                    # Ở đây dùng tạm IP Info city hoặc fallback
-                    display_name = data.get("city", "Vị trí của bạn")
-            except:
-                return {"error": "Lỗi định vị IP"}
-        else:
-            # Tìm theo tên thành phố (Dùng Key cũ của bạn để tìm tọa độ)
-            if not WEATHER_API_KEY: return {"error": "Thiếu API Key để tìm thành phố"}
-            
-            geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city_name}&limit=1&appid={WEATHER_API_KEY}"
-            try:
-                geo_res = requests.get(geo_url, timeout=5).json()
-                if geo_res:
-                    lat = geo_res[0]['lat']
-                    lon = geo_res[0]['lon']
-                    display_name = geo_res[0]['name'] # Tên chuẩn quốc tế
-                else:
-                    return {"error": f"Không tìm thấy: {city_name}"}
-            except:
-                return {"error": "Lỗi kết nối Geocoding"}
-
-        if lat is None or lon is None:
-            return {"error": "Không xác định được tọa độ"}
-
-        # 2. Gọi Open-Meteo (API Free xịn cho Hourly)
-        url = (
-            f"https://api.open-meteo.com/v1/forecast?"
-            f"latitude={lat}&longitude={lon}&"
-            f"current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&"
-            f"hourly=temperature_2m,weather_code&"
-            f"timezone=auto&forecast_days=2"
-        )
-        
-        res = requests.get(url, timeout=5).json()
+        vi_tri = _XacDinhViTri(city_name)
+        if isinstance(vi_tri, dict): return vi_tri
+        lat, lon, display_name = vi_tri
+
+        # 2. Gọi Open-Meteo (API Free xịn cho Hourly) - qua cache theo ô lưới
+        res = _TaiDuBao(lat, lon)
         if "error" in res: return {"error": "Lỗi Open-Meteo"}
 
         # 3. Xử lý dữ liệu trả về
-        current = res["current"]
-        hourly = res["hourly"]
-        
-        now_hour = datetime.datetime.now().hour
-        is_day = 6 <= now_hour <= 18
-        icon_code_current = convert_wmo_to_owm(current["weather_code"], is_day)
-
-        # Map code sang tiếng Việt
-        weather_desc = "Có mây"
-        c = current["weather_code"]
-        if c == 0: weather_desc = "Trời quang"
-        elif c in [1, 2, 3]: weather_desc = "Nhiều mây"
-        elif c in [61, 63, 65, 80, 81, 82]: weather_desc = "Mưa"
-        elif c >= 95: weather_desc = "Dông bão"
-
-        # Xử lý Hourly (lấy 12 mốc tiếp theo)
-        hourly_data = []
-        current_iso = datetime.datetime.now().strftime("%Y-%m-%dT%H:00")
-        try:
-            start_index = 0
-            for i, t in enumerate(hourly["time"]):
-                if t >= current_iso:
-                    start_index = i
-                    break
-            
-            for i in range(start_index, start_index + 12):
-                if i >= len(hourly["time"]): break
-                raw_time = hourly["time"][i]
-                time_str = raw_time.split("T")[1] # Lấy giờ "14:00"
-                
-                h_val = int(time_str.split(":")[0])
-                h_is_day = 6 <= h_val <= 18
-                
-                hourly_data.append({
-                    "time": time_str,
-                    "temp": round(hourly["temperature_2m"][i]),
-                    "icon_code": convert_wmo_to_owm(hourly["weather_code"][i], h_is_day)
-                })
-        except: pass
-
-        return {
-            "city": display_name,
-            "temp": round(current["temperature_2m"]),
-            "temp_min": round(min(hourly["temperature_2m"][:24])),
-            "temp_max": round(max(hourly["temperature_2m"][:24])),
-            "desc": weather_desc,
-            "icon_code": icon_code_current,
-            "humidity": f"{current['relative_humidity_2m']}%",
-            "wind_speed": f"{current['wind_speed_10m']} km/h",
-            "pressure": f"{round(current['surface_pressure'])} hPa",
-            "visibility": f"{round(current['visibility'] / 1000, 1)} km",
-            "hourly": hourly_data
-        }
+        return _DinhDangThoiTiet(res, display_name)
 
     except Exception as e:
         print(f"❌ Lỗi GetWeatherJson: {e}")
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+# =========================================================
+# THỜI TIẾT NHIỀU THÀNH PHỐ (/api/weather_batch)
+# =========================================================
+# Geocode song song (giới hạn số luồng), sau đó gom mọi ô lưới chưa có trong cache
+# vào 1 request Open-Meteo nhiều toạ độ (latitude=a,b,c&longitude=x,y,z).
+WEATHER_BATCH_WORKERS = int(os.getenv("WEATHER_BATCH_WORKERS", "4"))
+MULTI_LOCATION_CHUNK = 50
+_weather_pool = ThreadPoolExecutor(max_workers=WEATHER_BATCH_WORKERS, thread_name_prefix="weather")
+
+def _TaiTruocDuBao(positions):
+    """Nạp sẵn cache dự báo cho các ô lưới còn thiếu bằng request nhiều toạ độ."""
+    cells = []
+    for lat, lon in positions:
+        cell = _OLuoi(lat, lon)
+        if cell not in cells and _weather_cache.get(f"forecast:{cell[0]}:{cell[1]}") is None:
+            cells.append(cell)
+    if len(cells) < 2:
+        return  # 0-1 ô: để _TaiDuBao tự gọi như bình thường
+
+    ttl = _ThoiGianDenLanCapNhat()
+    for k in range(0, len(cells), MULTI_LOCATION_CHUNK):
+        chunk = cells[k:k + MULTI_LOCATION_CHUNK]
+        lats = ",".join(str(c[0]) for c in chunk)
+        lons = ",".join(str(c[1]) for c in chunk)
+        try:
+            res = http_get(_UrlOpenMeteo(lats, lons), timeout=8).json()
+        except Exception as e:
+            print(f"⚠️ Lỗi Open-Meteo nhiều toạ độ: {e}")
+            continue
+        # Nhiều toạ độ -> Open-Meteo trả về list theo đúng thứ tự gửi lên
+        if not isinstance(res, list) or len(res) != len(chunk):
+            continue
+        for cell, item in zip(chunk, res):
+            if "error" not in item:
+                _weather_cache.set(f"forecast:{cell[0]}:{cell[1]}", item, ttl)
+
+def GetWeatherBatch(city_names):
+    """
+    Thời tiết cho nhiều thành phố. Generator trả về (index, city_name, data)
+    theo thứ tự có kết quả; data có cùng dạng với GetWeatherJson.
+    """
+    futures = {_weather_pool.submit(_XacDinhViTri, name): (i, name) for i, name in enumerate(city_names)}
+    resolved = []
+    for f in as_completed(futures):
+        i, name = futures[f]
+        try:
+            vi_tri = f.result()
+        except Exception as e:
+            vi_tri = {"error": str(e)}
+        if isinstance(vi_tri, dict):
+            yield i, name, vi_tri  # lỗi geocoding trả luôn, không chờ các thành phố khác
+        else:
+            resolved.append((i, name, vi_tri))
+
+    _TaiTruocDuBao([(lat, lon) for _, _, (lat, lon, _) in resolved])
+
+    for i, name, (lat, lon, display_name) in resolved:
+        try:
+            res = _TaiDuBao(lat, lon)
+            if "error" in res:
+                yield i, name, {"error": "Lỗi Open-Meteo"}
+            else:
+                yield i, name, _DinhDangThoiTiet(res, display_name)
+        except Exception as e:
+            print(f"❌ Lỗi GetWeatherBatch ({name}): {e}")
+            yield i, name, {"error": str(e)}
@@ -10,6 +10,7 @@ import threading
 import re  # QUAN TRỌNG: Dùng để bắt giờ chính xác
 import dateparser # pip install dateparser
 from datetime import datetime, timedelta
+from keyword_router import KeywordRouter
 
 # --- 1. KẾT NỐI FIREBASE ---
 from db_connect import db
@@ -21,6 +22,12 @@ try:
 except ImportError:
     def speak(text): print(f"🔊 [GIẢ LẬP NÓI]: {text}")
 
+# Phân loại nhắc nhở theo từ khoá (hoà điểm thì ưu tiên health như trước)
+CATEGORY_ROUTER = KeywordRouter({
+    'health': ['thuốc', 'bác sĩ', 'khám', 'gym', 'tập', 'thể dục', 'ngủ', 'ăn', 'uống', 'đau'],
+    'work': ['họp', 'deadline', 'báo cáo', 'mail', 'email', 'team', 'dự án', 'code', 'nộp', 'sếp', 'học', 'bài'],
+})
+
 class ReminderEngine:
     def __init__(self):
         # Không còn load_data() từ file nữa
@@ -37,10 +44,7 @@ class ReminderEngine:
         
     # --- [LOGIC GỐC] Tự động phân loại ---
     def determine_category(self, text):
-        text = text.lower()
-        if any(k in text for k in ['thuốc', 'bác sĩ', 'khám', 'gym', 'tập', 'thể dục', 'ngủ', 'ăn', 'uống', 'đau']): return 'health'
-        if any(k in text for k in ['họp', 'deadline', 'báo cáo', 'mail', 'team', 'dự án', 'code', 'nộp', 'sếp', 'học', 'bài']): return 'work'
-        return 'personal'
+        return CATEGORY_ROUTER.best(text, 'personal')
 
     # --- [LOGIC GỐC] HÀM XỬ LÝ THỜI GIAN (REGEX + DATEPARSER) ---
     def parse_voice_command(self, text):
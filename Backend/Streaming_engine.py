@@ -13,6 +13,7 @@ from datetime import datetime
 
 # Thêm import lưu history
 from history import save_history
+from metrics import timed
 
 # --- 1️⃣ Nạp API Key ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -79,15 +80,16 @@ def analyze_screen(question: str, user_id: str = None) -> str:
         with Image.open(filepath) as image:
             print(f"🤖 [Streaming] Đang gửi ảnh tới AI (User: {user_id})...")
             
-            response = model.generate_content(
-                [question, image],
-                safety_settings={
-                    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
-                    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
-                    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
-                    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
-                }
-            )
+            with timed("gemini_screen"):
+                response = model.generate_content(
+                    [question, image],
+                    safety_settings={
+                        "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+                        "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+                        "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+                        "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
+                    }
+                )
 
             answer = response.text.strip() if getattr(response, "text", None) else "⚠️ Không có phản hồi từ AI."
 
@@ -11,6 +11,7 @@ import google.generativeai as genai
 
 # Import hàm history mới
 from history import save_history
+from metrics import timed
 
 # --- 1️⃣ Nạp biến môi trường ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -47,15 +48,16 @@ def analyze_image(image_path: str, question: str = "Mô tả chi tiết nội du
             print(f"📸 [Vision_engine] Đang phân tích ảnh: {image_path}")
             
             # Gọi Google Gemini
-            response = model.generate_content(
-                [question, img],
-                safety_settings={
-                    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
-                    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
-                    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
-                    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
-                }
-            )
+            with timed("gemini_vision"):
+                response = model.generate_content(
+                    [question, img],
+                    safety_settings={
+                        "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+                        "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+                        "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+                        "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
+                    }
+                )
 
             answer = response.text.strip() if getattr(response, "text", None) else "⚠️ Không có phản hồi từ AI."
 
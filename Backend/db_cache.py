@@ -0,0 +1,135 @@
+# =====================================================
+# File: Backend/db_cache.py
+# Chức năng: Cache đọc-xuyên (read-through) cho document users/{uid}
+# =====================================================
+# Cùng một document users/{uid} bị đọc lại liên tục (tên người dùng mỗi lượt chat,
+# profile dinh dưỡng...). Module này giữ bản sao trong RAM với TTL ngắn.
+# Bật USER_DOC_LISTENER=1 để gắn snapshot listener của Firestore: document luôn
+# được cập nhật nóng trong RAM, không cần chờ hết TTL.
+# Nhiều lần miss đồng thời trên cùng uid chỉ đọc Firestore 1 lần (single-flight như ttl_cache);
+# invalidate() tăng "thế hệ" của uid để lần đọc đang chạy không ghi đè bản cũ vào cache.
+
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+from db_connect import db
+from metrics import timed
+from ttl_cache import _Flight
+
+USER_DOC_TTL = int(os.getenv("USER_DOC_TTL", "60"))
+USER_DOC_MAX = int(os.getenv("USER_DOC_MAX", "1000"))
+USER_DOC_LISTENER = os.getenv("USER_DOC_LISTENER", "0") == "1"
+
+class UserDocCache:
+    def __init__(self, ttl=60, max_size=1000, use_listener=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.use_listener = use_listener
+        self.lock = threading.Lock()
+        self.items = OrderedDict()   # uid -> (data | None, expires)
+        self.watches = {}            # uid -> snapshot watch
+        self.flights = {}            # uid -> _Flight: lần đọc Firestore đang chạy
+        self.generations = {}        # uid -> số lần invalidate
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _store(self, user_id, data, expires):
+        self.items[user_id] = (data, expires)
+        self.items.move_to_end(user_id)
+        while len(self.items) > self.max_size:
+            old_uid, _ = self.items.popitem(last=False)
+            watch = self.watches.pop(old_uid, None)
+            if watch:
+                watch.unsubscribe()
+
+    def get(self, user_id):
+        """Trả về bản sao dict của users/{uid}, hoặc None nếu document không tồn tại."""
+        if not user_id:
+            return None
+        with self.lock:
+            item = self.items.get(user_id)
+            if item and (item[1] is None or time.time() < item[1]):
+                self.items.move_to_end(user_id)
+                self.hits += 1
+                return copy.deepcopy(item[0])
+            self.misses += 1
+            flight = self.flights.get(user_id)
+            leader = flight is None
+            if leader:
+                flight = self.flights[user_id] = _Flight()
+                generation = self.generations.get(user_id, 0)
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.value)
+
+        doc_ref = db.collection('users').document(user_id)
+        try:
+            with timed("firestore_user_doc"):
+                doc = doc_ref.get()
+            data = doc.to_dict() if doc.exists else None
+            flight.value = data
+            with self.lock:
+                # Có invalidate() trong lúc đọc (VD: vừa lưu profile): bản vừa đọc có thể đã cũ
+                if self.generations.get(user_id, 0) == generation:
+                    self._store(user_id, data, time.time() + self.ttl)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(user_id) is flight:
+                    del self.flights[user_id]
+            flight.event.set()
+        if self.use_listener:
+            self._watch(user_id, doc_ref)
+        return copy.deepcopy(data)
+
+    def _watch(self, user_id, doc_ref):
+        with self.lock:
+            if user_id in self.watches:
+                return
+            self.watches[user_id] = None  # giữ chỗ, tránh gắn 2 listener
+
+        def on_snapshot(docs, changes, read_time):
+            for doc in docs:
+                data = doc.to_dict() if doc.exists else None
+                with self.lock:
+                    # expires=None: listener giữ dữ liệu luôn mới, không cần TTL
+                    self._store(user_id, data, None)
+
+        try:
+            watch = doc_ref.on_snapshot(on_snapshot)
+            with self.lock:
+                self.watches[user_id] = watch
+        except Exception as e:
+            print(f"⚠️ [db_cache] Không gắn được listener cho {user_id}: {e}")
+            with self.lock:
+                self.watches.pop(user_id, None)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.items.pop(user_id, None)
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            # Lần get() sau đọc lại Firestore, không nhập vào lần đọc đang chạy (có thể đã cũ)
+            self.flights.pop(user_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.items), "hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced, "listeners": len(self.watches)}
+
+user_doc_cache = UserDocCache(USER_DOC_TTL, USER_DOC_MAX, USER_DOC_LISTENER)
+
+def get_user_doc(user_id):
+    return user_doc_cache.get(user_id)
+
+def invalidate_user_doc(user_id):
+    user_doc_cache.invalidate(user_id)
@@ -0,0 +1,165 @@
+# =====================================================
+# File: Backend/db_writer.py
+# Chức năng: Ghi Firestore kiểu write-behind (gom nhiều lệnh ghi thành 1 WriteBatch)
+# =====================================================
+# Các lệnh ghi không cần kết quả ngay (chat_logs, history...) được đưa vào hàng đợi
+# và commit theo lô ở thread nền, nên không còn cộng thêm độ trễ cho người dùng.
+# - Flush khi đủ BATCH_SIZE lệnh hoặc sau FLUSH_INTERVAL giây.
+# - Hàng đợi có giới hạn: đầy thì ghi trực tiếp (không mất dữ liệu, không phình RAM).
+# - Commit lỗi thì thử lại với backoff; vẫn lỗi thì ghi từng lệnh riêng để 1 document hỏng
+#   không kéo theo cả lô. Tắt server thì xả hết hàng đợi.
+
+import os
+import time
+import queue
+import atexit
+import threading
+from db_connect import db
+from metrics import timed
+
+BATCH_SIZE = int(os.getenv("FIRESTORE_BATCH_SIZE", "100"))      # Firestore cho tối đa 500 lệnh/batch
+FLUSH_INTERVAL = float(os.getenv("FIRESTORE_FLUSH_INTERVAL", "1.0"))
+MAX_QUEUE = int(os.getenv("FIRESTORE_MAX_QUEUE", "5000"))
+MAX_RETRIES = 4
+RETRY_BUDGET = sum(0.5 * (2 ** i) for i in range(MAX_RETRIES))  # tổng thời gian backoff của 1 lô
+
+class WriteBehindQueue:
+    def __init__(self, batch_size=100, flush_interval=1.0, max_queue=5000):
+        self.batch_size = min(batch_size, 500)
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stop_event = threading.Event()
+        self.drain_timeout = 10.0
+        self.stats = {"queued": 0, "committed": 0, "batches": 0, "retries": 0, "dropped": 0, "direct": 0,
+                      "split": 0}
+        self.last_error = None  # lệnh ghi bị bỏ gần nhất: {"path", "error", "time"}
+        self.stats_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    # --- API ---
+    def add(self, collection_ref, data: dict):
+        """Giống collection_ref.add(data) nhưng ghi nền (ID tự sinh ngay tại client)."""
+        self.set(collection_ref.document(), data)
+
+    def set(self, doc_ref, data: dict, merge: bool = False):
+        op = (doc_ref, data, merge)
+        try:
+            self.queue.put_nowait(op)
+            self._count("queued")
+        except queue.Full:
+            # Hàng đợi đầy (Firestore chậm/mất mạng): ghi thẳng để không mất dữ liệu.
+            # Đây là luồng của request nên chỉ thử 1 lần, lỗi thì tính là bỏ chứ không ném ra.
+            self._count("direct")
+            try:
+                with timed("firestore_single_write"):
+                    doc_ref.set(data, merge=merge)
+                self._count("committed")
+            except Exception as e:
+                self._drop(op, e)
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+            stats["last_error"] = self.last_error
+        stats["pending"] = self.queue.qsize()
+        return stats
+
+    # --- Thread nền ---
+    def _collect(self):
+        """Chờ lệnh đầu tiên rồi gom thêm cho tới khi đủ lô hoặc hết FLUSH_INTERVAL."""
+        try:
+            ops = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.flush_interval
+        while len(ops) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                ops.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return ops
+
+    def _commit(self, ops):
+        error = None
+        for attempt in range(MAX_RETRIES):
+            try:
+                batch = db.batch()
+                for doc_ref, data, merge in ops:
+                    batch.set(doc_ref, data, merge=merge)
+                with timed("firestore_batch_commit"):
+                    batch.commit()
+                self._count("committed", len(ops))
+                self._count("batches")
+                return True
+            except Exception as e:
+                error = e
+                self._count("retries")
+                wait = 0.5 * (2 ** attempt)
+                print(f"⚠️ [db_writer] Commit lỗi (lần {attempt + 1}), thử lại sau {wait}s: {e}")
+                time.sleep(wait)
+        if len(ops) > 1:
+            return self._commit_each(ops)
+        self._drop(ops[0], error)
+        return False
+
+    def _commit_each(self, ops):
+        """Lô vẫn lỗi sau MAX_RETRIES: ghi từng lệnh riêng, chỉ bỏ những lệnh tự nó lỗi."""
+        print(f"⚠️ [db_writer] Lô {len(ops)} lệnh vẫn lỗi, chuyển sang ghi từng lệnh.")
+        self._count("split")
+        ok = True
+        for op in ops:
+            doc_ref, data, merge = op
+            try:
+                with timed("firestore_single_write"):
+                    doc_ref.set(data, merge=merge)
+                self._count("committed")
+            except Exception as e:
+                self._drop(op, e)
+                ok = False
+        return ok
+
+    def _drop(self, op, error):
+        path = getattr(op[0], "path", "?")
+        print(f"❌ [db_writer] Bỏ lệnh ghi {path}: {error}")
+        self._count("dropped")
+        with self.stats_lock:
+            self.last_error = {"path": path, "error": str(error), "time": time.time()}
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            ops = self._collect()
+            if ops:
+                self._commit(ops)
+        # Tắt server: chính thread này xả nốt hàng đợi, nên không bao giờ có 2 commit
+        # chạy song song và thứ tự ghi được giữ nguyên
+        deadline = time.time() + self.drain_timeout
+        while time.time() < deadline:
+            ops = []
+            while len(ops) < self.batch_size:
+                try:
+                    ops.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not ops:
+                break
+            self._commit(ops)
+
+    def drain(self, timeout=10.0):
+        """Xả toàn bộ hàng đợi (gọi khi tắt server)."""
+        self.drain_timeout = timeout
+        self.stop_event.set()
+        # Chờ cả lô đang commit (có thể đang backoff) lẫn phần xả hàng đợi
+        self.thread.join(timeout=self.flush_interval + RETRY_BUDGET + timeout)
+        if self.thread.is_alive():
+            print(f"⚠️ [db_writer] Hết thời gian xả hàng đợi, còn {self.queue.qsize()} lệnh chưa ghi.")
+
+write_behind = WriteBehindQueue(BATCH_SIZE, FLUSH_INTERVAL, MAX_QUEUE)
+atexit.register(write_behind.drain)
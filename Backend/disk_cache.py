@@ -0,0 +1,151 @@
+# =====================================================
+# File: Backend/disk_cache.py
+# Chức năng: Cache key-value trên đĩa (SQLite) nằm sau cache RAM
+# =====================================================
+# Dữ liệu gần như không đổi (tóm tắt Wikipedia, toạ độ geocoding, tỷ giá trong ngày)
+# trước đây mất sạch mỗi lần khởi động lại server. Cache này giữ chúng qua các lần
+# restart: mỗi namespace có TTL riêng, tổng số bản ghi bị giới hạn và được dọn định kỳ.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DISK_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data", "DiskCache.db")
+DISK_CACHE_MAX_ROWS = int(os.getenv("DISK_CACHE_MAX_ROWS", "20000"))
+
+# TTL mặc định theo namespace (giây)
+NAMESPACE_TTLS = {
+    "wiki": 7 * 24 * 3600,   # tóm tắt Wikipedia
+    "geo": 30 * 24 * 3600,   # tên thành phố -> toạ độ
+    "fx": 3600,              # bảng tỷ giá
+    "translate": 30 * 24 * 3600,  # bản dịch prompt ảnh vi -> en
+}
+DEFAULT_TTL = 24 * 3600
+COMPACT_INTERVAL = int(os.getenv("DISK_CACHE_COMPACT_INTERVAL", "3600"))
+
+
+class DiskCache:
+    def __init__(self, path, max_rows=DISK_CACHE_MAX_ROWS, ttls=None, compact_every=500):
+        self.path = path
+        self.max_rows = max_rows
+        self.ttls = dict(NAMESPACE_TTLS if ttls is None else ttls)
+        self.compact_every = compact_every  # số lần ghi giữa 2 lần compact
+        self.lock = threading.Lock()
+        self.writes_since_compact = 0
+        self.counters = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0}
+        self.conn = None
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " namespace TEXT, key TEXT, value TEXT, expires REAL, accessed REAL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS kv_accessed ON kv (accessed)")
+            self.conn.commit()
+            self.compact()
+        except Exception as e:
+            print(f"⚠️ [DiskCache] Không mở được SQLite, bỏ qua cache đĩa: {e}")
+            self.conn = None
+
+    def get(self, namespace, key):
+        """Trả về giá trị (đã giải JSON) hoặc None nếu không có / hết hạn."""
+        if self.conn is None:
+            return None
+        now = time.time()
+        with self.lock:
+            try:
+                row = self.conn.execute(
+                    "SELECT value, expires FROM kv WHERE namespace = ? AND key = ?",
+                    (namespace, key)
+                ).fetchone()
+                if row and row[1] > now:
+                    self.conn.execute(
+                        "UPDATE kv SET accessed = ? WHERE namespace = ? AND key = ?",
+                        (now, namespace, key)
+                    )
+                    self.conn.commit()
+                    self.counters["hits"] += 1
+                    return json.loads(row[0])
+            except Exception as e:
+                print(f"⚠️ [DiskCache] Lỗi đọc SQLite: {e}")
+            self.counters["misses"] += 1
+            return None
+
+    def set(self, namespace, key, value, ttl=None):
+        if self.conn is None:
+            return
+        ttl = self.ttls.get(namespace, DEFAULT_TTL) if ttl is None else ttl
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?, ?)",
+                    (namespace, key, json.dumps(value, ensure_ascii=False), now + ttl, now)
+                )
+                self.conn.commit()
+                self.counters["writes"] += 1
+                self.writes_since_compact += 1
+            except Exception as e:
+                print(f"⚠️ [DiskCache] Lỗi ghi SQLite: {e}")
+                return
+        if self.writes_since_compact >= self.compact_every:
+            self.compact()
+
+    def get_or_load(self, namespace, key, loader, cacheable=None, ttl=None):
+        """Đọc xuyên: có trên đĩa thì trả luôn, không thì gọi loader() và lưu nếu cacheable."""
+        value = self.get(namespace, key)
+        if value is not None:
+            return value
+        value = loader()
+        if value is not None and (cacheable is None or cacheable(value)):
+            self.set(namespace, key, value, ttl)
+        return value
+
+    def compact(self, vacuum=False):
+        """Xoá bản ghi hết hạn, cắt bớt bản ghi ít dùng nhất khi vượt max_rows."""
+        if self.conn is None:
+            return 0
+        with self.lock:
+            self.writes_since_compact = 0
+            try:
+                removed = self.conn.execute("DELETE FROM kv WHERE expires < ?", (time.time(),)).rowcount
+                total = self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+                if total > self.max_rows:
+                    removed += self.conn.execute(
+                        "DELETE FROM kv WHERE rowid IN (SELECT rowid FROM kv ORDER BY accessed LIMIT ?)",
+                        (total - self.max_rows,)
+                    ).rowcount
+                self.conn.commit()
+                if vacuum:
+                    self.conn.execute("VACUUM")
+                self.counters["evicted"] += removed
+                return removed
+            except Exception as e:
+                print(f"⚠️ [DiskCache] Lỗi compact: {e}")
+                return 0
+
+    def stats(self):
+        if self.conn is None:
+            return {"enabled": False}
+        with self.lock:
+            rows = self.conn.execute("SELECT namespace, COUNT(*) FROM kv GROUP BY namespace").fetchall()
+            return {"enabled": True, "max_rows": self.max_rows, "namespaces": dict(rows), **self.counters}
+
+    def start_compactor(self, interval=COMPACT_INTERVAL):
+        """Luồng nền compact định kỳ (VACUUM mỗi lần để trả lại dung lượng file)."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.compact(vacuum=True)
+        if self.conn is not None:
+            threading.Thread(target=loop, daemon=True, name="disk-cache-compactor").start()
+        return self
+
+
+disk_cache = DiskCache(DISK_CACHE_PATH).start_compactor()
@@ -7,7 +7,10 @@ import os
 from datetime import datetime
 from db_connect import db  # Import kết nối Firebase
 from firebase_admin import firestore
+from db_writer import write_behind
+from metrics import timed
 
+@timed("save_history")
 def save_history(entry: dict, user_id: str = None):
     """
     Lưu một mục lịch sử vào Firestore của người dùng cụ thể.
@@ -31,10 +34,11 @@ def save_history(entry: dict, user_id: str = None):
 
         # 2. Ghi vào sub-collection 'history' của user đó
         # Đường dẫn: users -> [UID] -> history -> [Auto ID]
-        db.collection('users').document(user_id)\
-          .collection('history').add(entry)
+        # Ghi nền qua write-behind (gom batch), không chặn request
+        write_behind.add(db.collection('users').document(user_id)
+                           .collection('history'), entry)
 
-        print(f"✅ [History] Đã lưu hoạt động '{entry.get('type', 'unknown')}' cho user {user_id}")
+        print(f"✅ [History] Đã đưa hoạt động '{entry.get('type', 'unknown')}' vào hàng đợi lưu cho user {user_id}")
         return True
         
     except Exception as e:
@@ -0,0 +1,82 @@
+# =====================================================
+# File: Backend/http_client.py
+# Chức năng: HTTP client dùng chung (keep-alive, pool theo host, timeout & retry thống nhất)
+# =====================================================
+# Trước đây mỗi lần gọi requests.get/post đều mở TCP + TLS mới tới cùng vài host
+# (ipinfo.io, openweathermap, open-meteo, goldapi, alphavantage, newsdata, wikipedia,
+# huggingface). Module này giữ 1 Session duy nhất với pool kết nối theo host.
+
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import http_duration, http_requests
+
+DEFAULT_TIMEOUT = (3.05, 10)  # (connect, read) giây
+POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_HOSTS", "20"))    # số host giữ pool
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))      # số kết nối giữ lại mỗi host
+
+# Chỉ retry GET (idempotent); POST như sinh ảnh HuggingFace rất tốn nên không tự gửi lại
+_retry = Retry(
+    total=2,
+    connect=2,
+    read=1,
+    backoff_factor=0.3,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(["GET", "HEAD"]),
+    raise_on_status=False,
+)
+
+_adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=_retry)
+session = requests.Session()
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+_stats_lock = threading.Lock()
+_requests_by_host = {}
+
+def _request(method, url, **kwargs):
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    host = requests.utils.urlparse(url).netloc
+    with _stats_lock:
+        _requests_by_host[host] = _requests_by_host.get(host, 0) + 1
+    start = time.perf_counter()
+    status = "error"
+    try:
+        response = session.request(method, url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        http_duration.observe(time.perf_counter() - start, host=host)
+        http_requests.inc(host=host, status=status)
+
+def http_get(url, **kwargs):
+    return _request("GET", url, **kwargs)
+
+def http_post(url, **kwargs):
+    return _request("POST", url, **kwargs)
+
+def get_http_stats():
+    """
+    Theo từng host: số request đã gửi và số kết nối TCP thực sự mở (urllib3 đếm).
+    reuse_ratio = 1 - connections / requests (càng gần 1 càng tốt).
+    """
+    hosts = {}
+    pools = _adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host = pool.host if pool.port in (80, 443, None) else f"{pool.host}:{pool.port}"
+        item = hosts.setdefault(host, {"connections": 0, "pool_requests": 0})
+        item["connections"] += pool.num_connections
+        item["pool_requests"] += pool.num_requests
+    with _stats_lock:
+        for host, count in _requests_by_host.items():
+            hosts.setdefault(host, {"connections": 0, "pool_requests": 0})["requests"] = count
+    for item in hosts.values():
+        total = item["pool_requests"]
+        item["reuse_ratio"] = round(1 - item["connections"] / total, 3) if total else 0.0
+    return hosts
@@ -0,0 +1,127 @@
+# =====================================================
+# File: Backend/image_jobs.py
+# Chức năng: Hàng đợi job tạo ảnh chạy nền (giới hạn số worker)
+# =====================================================
+# Trước đây nhánh 'tạo ảnh' của /api/process gọi GenerateImages đồng bộ (asyncio.run +
+# POST HuggingFace vài chục giây) rồi còn sleep-poll kích thước file, giữ luôn luồng của
+# Flask. Giờ request chỉ đẩy job vào hàng đợi và trả job_id ngay; client hỏi
+# /api/jobs/<id> (có thể long-poll bằng ?wait=giây) để lấy trạng thái và URL ảnh.
+
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))        # số ảnh sinh đồng thời
+IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", "20"))  # job đang chờ + đang chạy
+JOB_RETENTION = 3600      # giữ job đã xong 1 giờ để client kịp hỏi
+JOB_MAX_KEEP = 500
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "error"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ImageJobQueue:
+    def __init__(self, max_workers=IMAGE_WORKERS, max_pending=IMAGE_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-job")
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.jobs = OrderedDict()  # job_id -> dict trạng thái
+        self.pending = 0
+
+    def submit(self, fn, prompt, *args, total=1, **kwargs):
+        """
+        Đưa fn(prompt, *args, **kwargs) vào hàng đợi, trả về job_id.
+        fn trả về 1 đường dẫn ảnh, hoặc là generator yield từng ảnh (total = số ảnh dự kiến).
+        """
+        with self.cond:
+            self._prune_locked()
+            if self.pending >= self.max_pending:
+                raise QueueFullError("Hàng đợi tạo ảnh đang đầy, thử lại sau.")
+            job_id = uuid.uuid4().hex[:12]
+            self.jobs[job_id] = {
+                "id": job_id, "status": QUEUED, "prompt": prompt,
+                "path": None, "paths": [], "total": total, "error": None,
+                "created_at": time.time(), "finished_at": None,
+            }
+            self.pending += 1
+        self.executor.submit(self._run, job_id, fn, prompt, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, fn, prompt, args, kwargs):
+        self._update(job_id, status=RUNNING)
+        try:
+            result = fn(prompt, *args, **kwargs)
+            paths = [result] if result is None or isinstance(result, str) else result
+            for path in paths:
+                if path:
+                    self._add_path(job_id, path)  # báo ngay cho client từng ảnh xong
+            if self._count_paths(job_id):
+                self._update(job_id, status=DONE, finished_at=time.time())
+            else:
+                self._update(job_id, status=FAILED, error="Không tạo được ảnh.", finished_at=time.time())
+        except Exception as e:
+            print(f"❌ [ImageJob] {job_id} lỗi: {e}")
+            self._update(job_id, status=FAILED, error=str(e), finished_at=time.time())
+        finally:
+            with self.cond:
+                self.pending -= 1
+
+    def _update(self, job_id, **fields):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+            self.cond.notify_all()
+
+    def _add_path(self, job_id, path):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job["paths"].append(path)
+                job["path"] = job["path"] or path
+            self.cond.notify_all()
+
+    def _count_paths(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            return len(job["paths"]) if job else 0
+
+    def _prune_locked(self):
+        now = time.time()
+        for job_id in list(self.jobs):
+            job = self.jobs[job_id]
+            expired = job["finished_at"] and now - job["finished_at"] > JOB_RETENTION
+            if expired or (len(self.jobs) > JOB_MAX_KEEP and job["finished_at"]):
+                del self.jobs[job_id]
+
+    def get(self, job_id, wait=0, since=0):
+        """
+        Trạng thái job (bản sao) hoặc None. wait > 0: chờ tối đa wait giây cho tới khi job xong
+        hoặc có thêm ảnh so với `since` ảnh client đã nhận.
+        """
+        deadline = time.time() + wait
+        with self.cond:
+            while True:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return None
+                remaining = deadline - time.time()
+                if job["status"] in (DONE, FAILED) or len(job["paths"]) > since or remaining <= 0:
+                    return {**job, "paths": list(job["paths"])}
+                self.cond.wait(remaining)
+
+    def stats(self):
+        with self.cond:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {"pending": self.pending, "max_pending": self.max_pending, "jobs": counts}
+
+
+image_jobs = ImageJobQueue()
@@ -0,0 +1,157 @@
+# =====================================================
+# File: Backend/keyword_router.py
+# Chức năng: Bộ định tuyến từ khoá biên dịch sẵn (nhiều mẫu, 1 lần quét)
+# =====================================================
+# Thay cho chuỗi any(k in t for k in [...]) rải rác ở nhiều module: mỗi lần any() lại
+# quét cả câu từ đầu, từ khoá nào được kiểm tra trước thì thắng ("giá" nuốt "giá vàng"),
+# và câu gõ không dấu / dấu tổ hợp (NFD) thì trượt.
+#
+# KeywordRouter gom mọi từ khoá của mọi intent vào 1 cây tiền tố (trie), biên dịch thành
+# 1 regex duy nhất và quét văn bản đã chuẩn hoá đúng 1 lần (trong C, nhanh hơn Aho-Corasick
+# viết bằng Python thuần). Ở mỗi vị trí lấy từ khoá dài nhất khớp trọn từ, nên "giá vàng"
+# được tính là 1 cụm chứ không còn là "giá" + "vàng". Kết quả: mọi intent khớp kèm trọng số.
+
+import re
+import unicodedata
+
+def normalize_text(text):
+    """Chữ thường, dạng NFC (dấu dựng sẵn). Khoảng trắng để nguyên: regex khớp bằng \\s+."""
+    text = (text or "").lower()
+    if not unicodedata.is_normalized("NFC", text):
+        text = unicodedata.normalize("NFC", text)
+    return text
+
+def strip_accents(text):
+    """Bỏ dấu tiếng Việt: 'thời tiết' -> 'thoi tiet'."""
+    text = unicodedata.normalize("NFD", text).replace("đ", "d").replace("Đ", "D")
+    return unicodedata.normalize("NFC", "".join(c for c in text if unicodedata.category(c) != "Mn"))
+
+def _trie_pattern(node):
+    """Trie {ký tự: node, '': True nếu kết thúc từ} -> regex; nhánh dài được thử trước."""
+    end = node.get("") is True
+    branches = [(r"\s+" if ch == " " else re.escape(ch)) + _trie_pattern(child)
+                for ch, child in sorted(node.items()) if ch]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if end:
+        # Tham lam: thử từ dài hơn trước, không khớp trọn từ thì lùi về từ ngắn
+        return "(?:" + body + ")?" if len(branches) > 1 or len(body) > 1 else body + "?"
+    return body
+
+
+class KeywordRouter:
+    """
+    rules: {intent: {từ khoá: trọng số}} (hoặc list từ khoá, trọng số 1).
+    Thứ tự intent trong rules là thứ tự ưu tiên khi hoà điểm.
+    accent_insensitive=True: từ khoá nhiều âm tiết khớp cả khi gõ không dấu
+    (từ 1 âm tiết như 'mưa' -> 'mua' dễ nhầm nên giữ nguyên dấu).
+    """
+
+    def __init__(self, rules, accent_insensitive=True):
+        self.order = {intent: i for i, intent in enumerate(rules)}
+        self.outputs = {}  # từ khoá đã chuẩn hoá -> [(intent, trọng số)]
+        for intent, keywords in rules.items():
+            if not isinstance(keywords, dict):
+                keywords = {k: 1.0 for k in keywords}
+            for keyword, weight in keywords.items():
+                keyword = " ".join(normalize_text(keyword).split())
+                forms = {keyword}
+                if accent_insensitive and " " in keyword:
+                    forms.add(strip_accents(keyword))
+                for form in forms:
+                    self.outputs.setdefault(form, []).append((intent, float(weight)))
+
+        trie = {}
+        for keyword in self.outputs:
+            node = trie
+            for ch in keyword:
+                node = node.setdefault(ch, {})
+            node[""] = True
+        # Đầu từ khoá phải là đầu 1 từ: kiểm tra trong scores() (lookbehind (?<!\w) bắt regex
+        # thử ở mọi vị trí, chậm gần gấp đôi); cuối từ khoá không được dính chữ/số.
+        self.regex = re.compile("(" + _trie_pattern(trie) + r")(?!\w)") if trie else None
+
+    def scores(self, text):
+        """{intent: tổng trọng số} của mọi từ khoá khớp, quét văn bản 1 lần."""
+        result = {}
+        if self.regex is None:
+            return result
+        text = normalize_text(text)
+        search = self.regex.search
+        pos = 0
+        while True:
+            m = search(text, pos)
+            if m is None:
+                return result
+            start = m.start()
+            if start and (text[start - 1].isalnum() or text[start - 1] == "_"):
+                pos = start + 1  # khớp giữa từ ("ăn" trong "căn"): bỏ, tìm tiếp từ ký tự sau
+                continue
+            keyword = m.group(1)
+            if keyword not in self.outputs:
+                keyword = " ".join(keyword.split())  # nhiều khoảng trắng / xuống dòng giữa các từ
+            for intent, weight in self.outputs[keyword]:
+                result[intent] = result.get(intent, 0.0) + weight
+            pos = m.end()
+
+    def match(self, text):
+        """Danh sách (intent, điểm) giảm dần theo điểm; hoà điểm theo thứ tự khai báo."""
+        return sorted(self.scores(text).items(), key=lambda kv: (-kv[1], self.order[kv[0]]))
+
+    def best(self, text, default=None):
+        matches = self.match(text)
+        return matches[0][0] if matches else default
+
+    def has(self, text, intent):
+        return intent in self.scores(text)
+
+
+if __name__ == '__main__':
+    # Micro-benchmark: chuỗi any() cũ của detect_intent so với KeywordRouter
+    import timeit
+
+    def detect_intent_cu(text):
+        t = text.lower()
+        if any(k in t for k in ["thời tiết", "mưa", "nắng", "weather", "nhiệt độ"]): return "weather"
+        if any(k in t for k in ["tỷ giá", "exchange", "usd", "vnd", "euro"]): return "exchange_rate"
+        if any(k in t for k in ["giá vàng", "vàng", "xau"]): return "gold_price"
+        if any(k in t for k in ["cổ phiếu", "chứng khoán", "stock", "giá", "mã"]): return "stock"
+        if any(k in t for k in ["ai là", "là ai", "tiểu sử", "who is"]): return "wiki"
+        if any(k in t for k in ["tin tức", "news", "breaking"]): return "news"
+        return "general"
+
+    router = KeywordRouter({
+        "weather": {"thời tiết": 3, "mưa": 1, "nắng": 1, "weather": 2, "nhiệt độ": 2},
+        "exchange_rate": {"tỷ giá": 3, "tỉ giá": 3, "exchange": 2, "usd": 2, "vnd": 1, "euro": 2},
+        "gold_price": {"giá vàng": 3, "vàng": 1.5, "xau": 2},
+        "stock": {"cổ phiếu": 3, "chứng khoán": 3, "stock": 2, "giá": 0.5, "mã": 0.5},
+        "wiki": {"ai là": 2, "là ai": 2, "tiểu sử": 3, "who is": 2},
+        "news": {"tin tức": 3, "news": 2, "breaking": 2},
+    })
+
+    cau_mau = [
+        "thời tiết hà nội hôm nay thế nào",
+        "giá vàng sjc hôm nay",
+        "tỷ giá usd sang vnd",
+        "thoi tiet da nang",
+        "cổ phiếu mã FPT",
+        "Sơn Tùng là ai",
+        "tin tức mới nhất về bóng đá",
+        "kể cho tôi một câu chuyện cười thật dài về con mèo và con chó",
+    ]
+    for cau in cau_mau:
+        print(f"{cau!r:70} cũ={detect_intent_cu(cau):14} mới={router.match(cau)}")
+
+    n = 20000
+    so_cau = n * len(cau_mau)
+    t_cu = timeit.timeit(lambda: [detect_intent_cu(c) for c in cau_mau], number=n)
+    t_moi = timeit.timeit(lambda: [router.best(c, "general") for c in cau_mau], number=n)
+    print(f"\nany() cũ (intent đầu tiên)  : {t_cu / so_cau * 1e6:.2f} µs/câu")
+    print(f"KeywordRouter (mọi intent)  : {t_moi / so_cau * 1e6:.2f} µs/câu")
+
+    # Trường hợp xấu nhất của chuỗi any(): không khớp gì nên phải quét hết mọi từ khoá
+    dai = cau_mau[-1] * 4
+    t_cu = timeit.timeit(lambda: detect_intent_cu(dai), number=n)
+    t_moi = timeit.timeit(lambda: router.best(dai, "general"), number=n)
+    print(f"Câu dài không khớp ({len(dai)} ký tự): any() {t_cu / n * 1e6:.2f} µs, KeywordRouter {t_moi / n * 1e6:.2f} µs")
@@ -0,0 +1,141 @@
+# =====================================================
+# File: Backend/metrics.py
+# Chức năng: Đo thời gian từng chặng xử lý, xuất dạng Prometheus (/api/metrics)
+# =====================================================
+# /api/process chậm thì trước đây chỉ có vài dòng safe_print, không biết do Cohere, Groq,
+# Firestore, Gemini hay HuggingFace. Mỗi lời gọi ra ngoài được bọc trong timed("chặng"):
+#   - vist_stage_duration_seconds{stage=...}  : histogram thời gian
+#   - vist_stage_errors_total{stage=...}      : số lần chặng ném exception
+# Trace ID của request hiện tại (set_trace_id) được gắn vào log khi một chặng chạy chậm.
+# Tự cài đặt định dạng text của Prometheus để không thêm phụ thuộc prometheus_client.
+
+import os
+import time
+import threading
+import contextlib
+from bisect import bisect_left
+
+# Mốc histogram (giây): từ đọc cache vài ms tới sinh ảnh vài chục giây
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SLOW_STAGE_SECONDS = float(os.getenv("SLOW_STAGE_SECONDS", "3"))
+
+_local = threading.local()
+
+
+def set_trace_id(trace_id):
+    """Gắn trace ID cho luồng hiện tại (mỗi task của /api/process chạy trên 1 luồng)."""
+    _local.trace_id = trace_id
+
+def get_trace_id():
+    return getattr(_local, "trace_id", None)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.series = {}  # label key -> [đếm theo bucket..., +Inf], tổng, số lần
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+stage_duration = Histogram("vist_stage_duration_seconds", "Thời gian từng chặng xử lý (LLM, Firestore, engine)")
+stage_errors = Counter("vist_stage_errors_total", "Số lần chặng xử lý ném exception")
+http_duration = Histogram("vist_http_request_seconds", "Thời gian request HTTP ra ngoài theo host")
+http_requests = Counter("vist_http_requests_total", "Số request HTTP ra ngoài theo host và mã trạng thái")
+tasks_total = Counter("vist_process_tasks_total", "Số task /api/process theo loại")
+
+_registry = [stage_duration, stage_errors, http_duration, http_requests, tasks_total]
+
+
+def observe_stage(stage, seconds):
+    stage_duration.observe(seconds, stage=stage)
+    if seconds >= SLOW_STAGE_SECONDS:
+        print(f"🐢 [Metrics] {stage} mất {seconds:.2f}s (trace={get_trace_id() or '-'})")
+
+
+class timed(contextlib.ContextDecorator):
+    """
+    Đo 1 chặng: dùng `with timed("groq_chat"):` hoặc làm decorator `@timed("save_history")`.
+    Exception vẫn được ném tiếp, chỉ đếm thêm vào vist_stage_errors_total.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self._starts = threading.local()
+
+    def __enter__(self):
+        stack = getattr(self._starts, "stack", None)
+        if stack is None:
+            stack = self._starts.stack = []
+        stack.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_stage(self.stage, time.perf_counter() - self._starts.stack.pop())
+        if exc_type is not None:
+            stage_errors.inc(stage=self.stage)
+        return False
+
+
+def render_prometheus():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
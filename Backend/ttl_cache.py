@@ -0,0 +1,241 @@
+# =====================================================
+# File: Backend/ttl_cache.py
+# Chức năng: Cache dùng chung - giới hạn kích thước, TTL, LRU, an toàn đa luồng
+# =====================================================
+# Ngoài get/set thông thường, get_or_load() gộp các lần miss đồng thời trên cùng 1 key
+# (single-flight): 5 người hỏi giá vàng cùng lúc thì chỉ có 1 request ra ngoài,
+# 4 người còn lại chờ và dùng chung kết quả.
+#
+# stale-while-revalidate: với stale_ttl > 0, giá trị hết hạn vẫn được giữ thêm một khoảng.
+# get_or_load(..., stale_ok=True) trả ngay giá trị cũ và tải lại ở thread nền;
+# BackgroundRefresher làm mới trước các key được hỏi nhiều nhất trước khi chúng hết hạn.
+
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+class _Flight:
+    """Một lần tải đang chạy cho 1 key."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class TTLCache:
+    def __init__(self, max_size=1000, default_ttl=300, stale_ttl=0, name="cache"):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # key -> (value, expires)
+        self.flights = {}           # key -> _Flight
+        self.loaders = {}           # key -> (loader, ttl, cacheable): dùng để làm mới nền
+        self.popularity = {}        # key -> điểm độ phổ biến (giảm dần theo thời gian)
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                         "loads": 0, "coalesced": 0, "stale_served": 0, "refreshes": 0}
+
+    def _forget_locked(self, key):
+        self.loaders.pop(key, None)
+        self.popularity.pop(key, None)
+
+    def _lookup_locked(self, key):
+        """Trả về (value, is_stale). value là _MISSING nếu không có/hết hạn hẳn."""
+        item = self.items.get(key)
+        if item is None:
+            self.counters["misses"] += 1
+            return _MISSING, False
+        value, expires = item
+        now = time.time()
+        if now <= expires:
+            self.items.move_to_end(key)
+            self.counters["hits"] += 1
+            return value, False
+        if now <= expires + self.stale_ttl:
+            self.counters["misses"] += 1
+            return value, True
+        del self.items[key]
+        self._forget_locked(key)
+        self.counters["expirations"] += 1
+        self.counters["misses"] += 1
+        return _MISSING, False
+
+    def get(self, key, default=None):
+        with self.lock:
+            value, stale = self._lookup_locked(key)
+        return default if value is _MISSING or stale else value
+
+    def set(self, key, value, ttl=None):
+        """ttl có thể là hàm value -> số giây (VD: thời gian còn lại của dữ liệu đọc từ đĩa)."""
+        ttl = self.default_ttl if ttl is None else ttl
+        if callable(ttl):
+            ttl = ttl(value)
+        with self.lock:
+            self.items[key] = (value, time.time() + ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                old_key, _ = self.items.popitem(last=False)
+                self._forget_locked(old_key)
+                self.counters["evictions"] += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+            self._forget_locked(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.loaders.clear()
+            self.popularity.clear()
+
+    def get_or_load(self, key, loader, ttl=None, cacheable=None, stale_ok=False):
+        """
+        Trả về giá trị trong cache; miss thì gọi loader() đúng 1 lần cho mọi thread đang chờ key này.
+        cacheable(value) -> bool: quyết định có lưu kết quả không (VD: không cache dict lỗi).
+        stale_ok=True: hết hạn nhưng còn trong stale_ttl thì trả giá trị cũ ngay và tải lại nền;
+        key cũng được theo dõi độ phổ biến để BackgroundRefresher làm mới trước.
+        """
+        background = None
+        with self.lock:
+            value, stale = self._lookup_locked(key)
+            if stale_ok:
+                self.loaders[key] = (loader, ttl, cacheable)
+                self.popularity[key] = self.popularity.get(key, 0) + 1
+            if value is not _MISSING and not stale:
+                return value
+
+            flight = self.flights.get(key)
+            if stale and stale_ok:
+                self.counters["stale_served"] += 1
+                if flight is None:
+                    background = self.flights[key] = _Flight()
+                    self.counters["loads"] += 1
+            else:
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = _Flight()
+                    self.counters["loads"] += 1
+                else:
+                    self.counters["coalesced"] += 1
+
+        if stale and stale_ok:
+            if background is not None:
+                threading.Thread(target=self._run_quietly, daemon=True,
+                                 args=(key, background, loader, ttl, cacheable)).start()
+            return value
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        return self._run_flight(key, flight, loader, ttl, cacheable)
+
+    def _run_flight(self, key, flight, loader, ttl, cacheable):
+        try:
+            value = loader()
+            flight.value = value
+            if value is not None and (cacheable is None or cacheable(value)):
+                self.set(key, value, ttl)
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+                if key not in self.items:
+                    self._forget_locked(key)
+            flight.event.set()
+
+    def _run_quietly(self, key, flight, loader, ttl, cacheable):
+        try:
+            self._run_flight(key, flight, loader, ttl, cacheable)
+        except Exception as e:
+            print(f"⚠️ [{self.name}] Lỗi tải lại nền '{key}': {e}")
+
+    # --- Hỗ trợ BackgroundRefresher ---
+    def hot_keys(self, n):
+        """n key được hỏi nhiều nhất (chỉ các key đã đăng ký loader)."""
+        with self.lock:
+            return sorted(self.popularity, key=self.popularity.get, reverse=True)[:n]
+
+    def decay_popularity(self, factor):
+        with self.lock:
+            for key in list(self.popularity):
+                self.popularity[key] *= factor
+                if self.popularity[key] < 0.01:
+                    self.popularity.pop(key)
+
+    def needs_refresh(self, key, ahead=0.2):
+        """True nếu key sắp hết hạn (còn < ahead * ttl) hoặc đã hết hạn."""
+        with self.lock:
+            registered = self.loaders.get(key)
+            if registered is None or key in self.flights:
+                return False
+            ttl = registered[1]
+            if ttl is None or callable(ttl):
+                ttl = self.default_ttl
+            item = self.items.get(key)
+            return item is None or item[1] - time.time() < ahead * ttl
+
+    def refresh(self, key):
+        """Tải lại key ngay trong thread hiện tại (bỏ qua nếu đang có lần tải khác)."""
+        with self.lock:
+            registered = self.loaders.get(key)
+            if registered is None or key in self.flights:
+                return False
+            flight = self.flights[key] = _Flight()
+            self.counters["loads"] += 1
+            self.counters["refreshes"] += 1
+        loader, ttl, cacheable = registered
+        self._run_quietly(key, flight, loader, ttl, cacheable)
+        return True
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.items)
+            stats["max_size"] = self.max_size
+            stats["tracked_hot_keys"] = len(self.popularity)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+class BackgroundRefresher:
+    """
+    Thread nền: mỗi `interval` giây, làm mới top_k key phổ biến nhất nếu sắp hết hạn,
+    để người dùng đầu tiên sau khi hết TTL không phải chờ API (tới 8s timeout).
+    """
+    def __init__(self, cache, interval=10, top_k=20, ahead=0.2, decay=0.8):
+        self.cache = cache
+        self.interval = interval
+        self.top_k = top_k
+        self.ahead = ahead
+        self.decay = decay
+        self.thread = None
+
+    def tick(self):
+        for key in self.cache.hot_keys(self.top_k):
+            if self.cache.needs_refresh(key, self.ahead):
+                self.cache.refresh(key)
+        # Key không còn ai hỏi sẽ dần rơi khỏi danh sách nóng
+        self.cache.decay_popularity(self.decay)
+
+    def _run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"⚠️ [{self.cache.name}] Lỗi refresher: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
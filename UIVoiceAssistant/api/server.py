@@ -4,10 +4,14 @@
 # ====================================================
 import sys
 import os
+import re
 import time
 import asyncio
 import threading
 import json
+import queue
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
@@ -33,20 +37,25 @@ from firebase_admin import firestore
 # IMPORT MODULES BACKEND (Giữ nguyên)
 # ====================================================
 try:
-    from Model import FirstLayerLLM
-    from Chatbot import ChatBot
+    from Model import FirstLayerLLM, PreRoute, normalize_utterance, get_router_stats, funcs
+    from Chatbot import ChatBot, ChatBotStream, SuaDinhDangTraLoi, LaCauHoiThoiTiet, SpeculativeChat, get_speculation_stats, get_prompt_stats
     from Automation import Automation
-    from RealTimeSearch_engine import RealtimeSearchEngine
+    from RealTimeSearch_engine import RealtimeSearchEngine, get_cache_stats
     from ImageGeneration import (
         GenerateImages,
-        RegenerateLastImage,
-        GenerateVariant,
-        get_latest_image_path
+        GenerateImageVariants,
+        prefetch_translation,
+        IMAGE_MAX_VARIANTS,
+        image_index
     )
     from Call_engine import ZaloCaller
     from Streaming_engine import analyze_screen
     from Vision_engine import analyze_uploaded_image
-    from RealtimeTools import GetWeatherJson
+    from RealtimeTools import GetWeatherJson, GetWeatherBatch
+    from http_client import get_http_stats
+    from db_writer import write_behind
+    from image_jobs import image_jobs, QueueFullError
+    from metrics import timed, observe_stage, set_trace_id, tasks_total, render_prometheus
     from Reminder_engine import reminder_engine  
     from STT_engine import start_listening, stop_listening, get_last_result
     from TTS_engine import speak
@@ -187,6 +196,162 @@ def api_analyze_image():
 # API CHÍNH /api/process (QUAN TRỌNG NHẤT)
 # Đây là nơi nhận Text từ Mobile/Web gửi về
 # ====================================================
+# Pool dùng chung để chạy song song các task của 1 câu lệnh
+# (VD: "mở facebook, chung ..., thời gian thực ...")
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "8"))
+task_executor = ThreadPoolExecutor(max_workers=TASK_WORKERS, thread_name_prefix="vist-task")
+_TASK_DONE = object()
+# Chế độ suy đoán: gọi ChatBot song song với FirstLayerLLM (mặc định tắt)
+SPECULATIVE_CHAT = os.getenv("SPECULATIVE_CHAT", "0") == "1"
+# Bật để cùng 1 prompt 'tạo ảnh' trả lại ảnh đã sinh thay vì gọi lại HuggingFace
+IMAGE_CACHE = os.getenv("IMAGE_CACHE", "0") == "1"
+
+# Task "tạo ảnh 3 ảnh con mèo" / "tạo ảnh ba tấm hình ..." (PreRoute và preamble giữ số lượng
+# kèm đơn vị) -> sinh nhiều biến thể song song. "tạo ảnh 2 con mèo" vẫn là 1 ảnh có 2 con mèo.
+_SO_ANH = {"hai": 2, "ba": 3, "bốn": 4, "năm": 5}
+_SO_ANH_RE = re.compile(
+    r"^(\d+|hai|ba|bốn|năm)\s+(?:(?:tấm|bức)\s+)?(?:ảnh|hình|tranh)\s+(.+)$", re.IGNORECASE
+)
+
+def parse_image_count(prompt):
+    """Tách số ảnh ở đầu prompt: ('3 ảnh con mèo') -> (3, 'con mèo'). Tối đa IMAGE_MAX_VARIANTS."""
+    m = _SO_ANH_RE.match(prompt.strip())
+    if not m:
+        return 1, prompt
+    so = m.group(1).lower()
+    n = int(so) if so.isdigit() else _SO_ANH[so]
+    return max(1, min(n, IMAGE_MAX_VARIANTS)), m.group(2)
+
+# Nhãn metrics của task = tiền tố func khớp dài nhất ("thời gian thực", "phân tích màn hình"...),
+# không phải từ đầu tiên ("thời", "phân" làm lẫn các loại task với nhau)
+def task_label(task):
+    for prefix in sorted(set(funcs) | {"phân tích ảnh upload"}, key=len, reverse=True):
+        if task == prefix or task.startswith(prefix + " "):
+            return prefix.replace(" ", "_")
+    return "khác"
+
+def image_url_for(path):
+    # Frontend tự ghép IP, ở đây trả full url local cũng được
+    return f"http://127.0.0.1:5000/data/{os.path.basename(path)}"
+
+def run_task(task: str, user_id, emit, stream_chat=False):
+    """
+    Xử lý 1 task do FirstLayerLLM trả về.
+    Mỗi dòng NDJSON cần gửi cho Frontend được đẩy ra qua emit(item).
+    stream_chat=True: câu trả lời chat được gửi dần qua các dòng 'chat-delta'.
+    """
+    response_item = None
+
+    # 1a. Chat thường (stream từng token)
+    if task.startswith('chung ') and stream_chat:
+        cac_doan = []
+        try:
+            for delta in ChatBotStream(task[6:], user_id=user_id):
+                cac_doan.append(delta)
+                emit({'type': 'chat-delta', 'content': delta})
+        except Exception as e:
+            # Stream Groq đứt giữa chừng: chốt phần đã nhận (đã được lưu lịch sử) rồi báo lỗi
+            safe_print("❌ Lỗi stream chat:", e)
+            if cac_doan:
+                emit({'type': 'chat', 'content': SuaDinhDangTraLoi("".join(cac_doan))})
+            response_item = {'type': 'error', 'content': "Câu trả lời bị gián đoạn, vui lòng thử lại."}
+        else:
+            res = SuaDinhDangTraLoi("".join(cac_doan))
+            response_item = {'type': 'chat', 'content': res}
+            speak_with_status(res)
+
+    # 1b. Chat thường
+    elif task.startswith('chung '):
+        # 👇 TRUYỀN UID VÀO CHATBOT ĐỂ LƯU LỊCH SỬ ĐÚNG NGƯỜI
+        res = ChatBot(task[6:], user_id=user_id)
+        response_item = {'type': 'chat', 'content': res}
+        # Server log lại, không phát âm thanh
+        speak_with_status(res)
+
+    # 2. Search thời gian thực
+    elif task.startswith('thời gian thực '):
+        res = RealtimeSearchEngine(task[15:], user_id=user_id)
+        response_item = {'type': 'realtime', 'content': res}
+        speak_with_status(res)
+
+    # 3. TẠO ẢNH (chạy nền: trả job_id ngay, client hỏi /api/jobs/<id> để lấy URL)
+    elif task.startswith('tạo ảnh '):
+        n, prompt = parse_image_count(task[8:])
+        safe_print(f"🎨 Tạo {n} ảnh prompt: {prompt}")
+        try:
+            prefetch_translation(prompt)  # dịch trong lúc job còn xếp hàng
+            if n > 1:
+                job_id = image_jobs.submit(GenerateImageVariants, prompt, n, total=n)
+            else:
+                job_id = image_jobs.submit(GenerateImages, prompt, use_cache=IMAGE_CACHE)
+            emit({'type': 'image-start', 'content': prompt, 'job_id': job_id, 'total': n})
+        except QueueFullError as e:
+            response_item = {'type': 'error', 'content': str(e)}
+
+    # 4. Phân tích màn hình
+    elif task.startswith('phân tích màn hình '):
+        try:
+            res = analyze_screen(task[18:], user_id=user_id)
+        except TypeError:
+            res = analyze_screen(task[18:]) 
+        except Exception as e:
+            res = f"Lỗi khi phân tích màn hình: {str(e)}"
+
+        response_item = {'type': 'screen', 'content': res}
+        speak_with_status(str(res))
+
+    # 5. Phân tích ảnh upload (qua voice)
+    elif task.startswith('phân tích ảnh upload '):
+        prompt = task[21:]
+        try:
+            res = analyze_uploaded_image(None, prompt, user_id=user_id)
+            response_item = {'type': 'vision', 'content': res}
+            speak_with_status(str(res))
+        except Exception as e:
+            error_msg = f"Lỗi xử lý ảnh: {str(e)}"
+            safe_print("❌", error_msg)
+            response_item = {'type': 'error', 'content': error_msg}
+        
+    # 6. Gọi Zalo
+    elif task.startswith('gọi zalo '):
+        target = task[9:]
+        try:
+            ZaloCaller().call(target, 'audio')
+            msg = f'Đang gọi Zalo: {target}'
+        except Exception as e:
+            msg = f'Lỗi gọi Zalo: {e}'
+        response_item = {'type': 'call', 'content': msg}
+        speak_with_status(msg)
+
+    # 7. Nhắc nhở
+    elif task.startswith('nhắc nhở '):
+        reminder_text = task.removeprefix('nhắc nhở ')
+        try:
+            res_msg = reminder_engine.add_reminder_voice(user_id, reminder_text)
+            response_item = {'type': 'action', 'content': res_msg}
+            speak_with_status(res_msg)
+        except Exception as e:
+            err_msg = f"Lỗi tạo lịch: {str(e)}"
+            safe_print("❌", err_msg)
+            response_item = {'type': 'error', 'content': err_msg}
+            
+    # 8. Mở ứng dụng (Chỉ hoạt động trên Laptop Server)
+    elif task.startswith('mở '):
+        param = task
+        # Automation chạy trên máy Server (Laptop)
+        threading.Thread(target=lambda: asyncio.run(Automation([param]))).start()
+        response_item = {'type': 'action', 'content': f'Đang mở trên Laptop: {task[3:]}'}
+
+    # 9. Default action
+    else:
+        param = task
+        threading.Thread(target=lambda: asyncio.run(Automation([param]))).start()
+        response_item = {'type': 'action', 'content': f'Đã gửi lệnh: {task}'}
+
+    # Gửi kết quả về cho Frontend
+    if response_item:
+        emit(response_item)
+
 @app.route('/api/process', methods=['POST'])
 def api_process():
     try:
@@ -196,131 +361,127 @@ def api_process():
         
         # 👇 LẤY UID TỪ JSON FRONTEND GỬI LÊN
         user_id = data.get('uid') or CURRENT_USER_ID
+        # Client hỗ trợ 'chat-delta' thì gửi kèm "stream": true
+        stream_chat = bool(data.get('stream'))
+        speculative = bool(data.get('speculative', SPECULATIVE_CHAT))
 
         if not text: return jsonify({'error': 'No text provided'}), 400
 
-        safe_print(f"📩 NHẬN TỪ MOBILE ({user_id}): {text}")
+        # Trace ID gắn vào mọi dòng NDJSON và log chặng chậm để lần ra request nào chậm ở đâu
+        trace_id = request.headers.get('X-Trace-Id') or uuid.uuid4().hex[:16]
+        safe_print(f"📩 NHẬN TỪ MOBILE ({user_id}) [trace={trace_id}]: {text}")
 
         def generate():
+            started = time.perf_counter()
+            set_trace_id(trace_id)
+            # Suy đoán: câu lệnh rõ ràng (PreRoute bắt được) hoặc hỏi thời tiết thì không cần
+            spec = None
+            if speculative and not LaCauHoiThoiTiet(text) and not PreRoute(text):
+                spec = SpeculativeChat(text, user_id, task_executor)
+
             # Đưa text vào bộ não (LLM) để phân tích ý định
             tasks = FirstLayerLLM(text)
-            
-            for task in tasks:
-                try:
-                    response_item = None
-                    
-                    # 1. Chat thường
-                    if task.startswith('chung '):
-                        # 👇 TRUYỀN UID VÀO CHATBOT ĐỂ LƯU LỊCH SỬ ĐÚNG NGƯỜI
-                        res = ChatBot(task[6:], user_id=user_id)
-                        response_item = {'type': 'chat', 'content': res}
-                        # Server log lại, không phát âm thanh
-                        speak_with_status(res)
 
-                    # 2. Search thời gian thực
-                    elif task.startswith('thời gian thực '):
-                        res = RealtimeSearchEngine(task[15:], user_id=user_id)
-                        response_item = {'type': 'realtime', 'content': res}
+            if spec:
+                is_chat = (len(tasks) == 1 and tasks[0].startswith('chung ')
+                           and normalize_utterance(tasks[0][6:]) == normalize_utterance(text))
+                res, da_stream = None, False
+                if is_chat:
+                    # Client nhận 'chat-delta': phát lại các đoạn đã sinh rồi stream tiếp
+                    if stream_chat:
+                        for delta in spec.stream():
+                            da_stream = True
+                            yield json.dumps({'type': 'chat-delta', 'content': delta, 'index': 0, 'trace_id': trace_id}) + "\n"
+                    res = spec.use()
+                else:
+                    spec.discard()
+                if res is not None or da_stream:
+                    if res is not None:
                         speak_with_status(res)
-
-                    # 3. TẠO ẢNH
-                    elif task.startswith('tạo ảnh '):
-                        prompt = task[8:]
-                        safe_print(f"🎨 Tạo ảnh prompt: {prompt}")
-                        yield json.dumps({'type': 'image-start', 'content': prompt}) + "\n"
-                        try:
-                            path = GenerateImages(prompt)
-                            # Đợi ảnh được tạo xong
-                            for _ in range(20):
-                                if os.path.exists(path) and os.path.getsize(path) > 1500: break
-                                time.sleep(0.25)
-                            filename = os.path.basename(path)
-                            # Trả về URL ảnh cho App hiển thị
-                            # LƯU Ý: Frontend dùng API_BASE từ config nên URL này chỉ cần đúng path
-                            # Nhưng ở đây ta trả full url cho chắc, client sẽ xử lý
-                            # Để tương thích Mobile, ta dùng path relative hoặc để client tự ghép
-                            image_url = f"http://127.0.0.1:5000/data/{filename}" 
-                            msg = f'Đã tạo ảnh cho: {prompt}'
-                            safe_print(msg)
-                            response_item = {'type': 'image', 'content': image_url}
-                        except Exception as e:
-                             safe_print("❌ GenerateImages error:", e)
-                             response_item = {'type': 'error', 'content': str(e)}
-
-                    # 4. Phân tích màn hình
-                    elif task.startswith('phân tích màn hình '):
-                        try:
-                            res = analyze_screen(task[18:], user_id=user_id)
-                        except TypeError:
-                            res = analyze_screen(task[18:]) 
-                        except Exception as e:
-                            res = f"Lỗi khi phân tích màn hình: {str(e)}"
-
-                        response_item = {'type': 'screen', 'content': res}
-                        speak_with_status(str(res))
-
-                    # 5. Phân tích ảnh upload (qua voice)
-                    elif task.startswith('phân tích ảnh upload '):
-                        prompt = task[21:]
-                        try:
-                            res = analyze_uploaded_image(None, prompt, user_id=user_id)
-                            response_item = {'type': 'vision', 'content': res}
-                            speak_with_status(str(res))
-                        except Exception as e:
-                            error_msg = f"Lỗi xử lý ảnh: {str(e)}"
-                            safe_print("❌", error_msg)
-                            response_item = {'type': 'error', 'content': error_msg}
-                        
-                    # 6. Gọi Zalo
-                    elif task.startswith('gọi zalo '):
-                        target = task[9:]
-                        try:
-                            ZaloCaller().call(target, 'audio')
-                            msg = f'Đang gọi Zalo: {target}'
-                        except Exception as e:
-                            msg = f'Lỗi gọi Zalo: {e}'
-                        response_item = {'type': 'call', 'content': msg}
-                        speak_with_status(msg)
-
-                    # 7. Nhắc nhở
-                    elif task.startswith('nhắc nhở '):
-                        reminder_text = task.removeprefix('nhắc nhở ')
-                        try:
-                            res_msg = reminder_engine.add_reminder_voice(user_id, reminder_text)
-                            response_item = {'type': 'action', 'content': res_msg}
-                            speak_with_status(res_msg)
-                        except Exception as e:
-                            err_msg = f"Lỗi tạo lịch: {str(e)}"
-                            safe_print("❌", err_msg)
-                            response_item = {'type': 'error', 'content': err_msg}
-                            
-                    # 8. Mở ứng dụng (Chỉ hoạt động trên Laptop Server)
-                    elif task.startswith('mở '):
-                        param = task
-                        # Automation chạy trên máy Server (Laptop)
-                        threading.Thread(target=lambda: asyncio.run(Automation([param]))).start()
-                        response_item = {'type': 'action', 'content': f'Đang mở trên Laptop: {task[3:]}'}
-
-                    # 9. Default action
+                        item = {'type': 'chat', 'content': res}
                     else:
-                        param = task
-                        threading.Thread(target=lambda: asyncio.run(Automation([param]))).start()
-                        response_item = {'type': 'action', 'content': f'Đã gửi lệnh: {task}'}
-
-                    # Gửi kết quả về cho Frontend
-                    if response_item:
-                        yield json.dumps(response_item) + "\n"
-
+                        # Đã gửi một phần câu trả lời rồi mới lỗi: không chạy lại từ đầu
+                        item = {'type': 'error', 'content': "Câu trả lời bị gián đoạn, vui lòng thử lại."}
+                    yield json.dumps({**item, 'index': 0, 'trace_id': trace_id}) + "\n"
+                    observe_stage("api_process", time.perf_counter() - started)
+                    return
+
+            results = queue.Queue()
+
+            def worker(index, task):
+                # Mỗi dòng mang 'index' của task để Frontend sắp xếp lại nếu cần
+                def emit(item):
+                    item['index'] = index
+                    item['trace_id'] = trace_id
+                    results.put(item)
+                set_trace_id(trace_id)
+                task_type = task_label(task)
+                tasks_total.inc(task=task_type)
+                try:
+                    with timed(f"task_{task_type}"):
+                        run_task(task, user_id, emit, stream_chat=stream_chat)
                 except Exception as e_task:
                     safe_print("❌ Lỗi task:", e_task)
-                    yield json.dumps({'type': 'error', 'content': str(e_task)}) + "\n"
-
-        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+                    emit({'type': 'error', 'content': str(e_task)})
+                finally:
+                    results.put(_TASK_DONE)
+
+            # Chạy song song: task nào xong trước thì gửi trước
+            for index, task in enumerate(tasks):
+                task_executor.submit(worker, index, task)
+
+            remaining = len(tasks)
+            while remaining:
+                item = results.get()
+                if item is _TASK_DONE:
+                    remaining -= 1
+                    continue
+                yield json.dumps(item) + "\n"
+            observe_stage("api_process", time.perf_counter() - started)
+
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.headers['X-Trace-Id'] = trace_id
+        return response
 
     except Exception as e:
         safe_print("❌ /api/process error:", e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    # Histogram thời gian từng chặng (Cohere, Groq, Gemini, HuggingFace, Firestore...) dạng Prometheus
+    return Response(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/router_stats', methods=['GET'])
+def api_router_stats():
+    # Tỉ lệ lệnh được PreRoute xử lý (không cần gọi Cohere) và p50 từng nhánh
+    return jsonify(get_router_stats())
+
+@app.route('/api/speculation_stats', methods=['GET'])
+def api_speculation_stats():
+    # Số lần ChatBot suy đoán được dùng / bị hủy và số token lãng phí
+    return jsonify(get_speculation_stats())
+
+@app.route('/api/chat_prompt_stats', methods=['GET'])
+def api_chat_prompt_stats():
+    # Kích thước prompt ChatBot (token ước lượng) sau khi nén lịch sử
+    return jsonify(get_prompt_stats())
+
+@app.route('/api/http_stats', methods=['GET'])
+def api_http_stats():
+    # Số request / số kết nối TCP mở theo từng host (tỉ lệ tái sử dụng keep-alive)
+    return jsonify(get_http_stats())
+
+@app.route('/api/cache_stats', methods=['GET'])
+def api_cache_stats():
+    # Cache tìm kiếm thời gian thực: hit/miss/eviction, hit rate, kèm thống kê cache đĩa
+    return jsonify(get_cache_stats())
+
+@app.route('/api/db_writer_stats', methods=['GET'])
+def api_db_writer_stats():
+    # Hàng đợi ghi Firestore: số lệnh chờ, đã commit, bị bỏ (kèm lỗi gần nhất)
+    return jsonify(write_behind.get_stats())
+
 # ====================================================
 # STATIC SERVE ẢNH (GIỮ NGUYÊN)
 # ====================================================
@@ -337,21 +498,33 @@ def serve_data_file(filename):
 # ====================================================
 @app.route('/api/get_latest_image', methods=['GET'])
 def get_latest_image():
-    path = get_latest_image_path()
-    if not path: return jsonify({'image': None})
-    
-    # Chờ ảnh ghi xong
-    for _ in range(20):
-        if os.path.exists(path) and os.path.getsize(path) > 1500: break
-        time.sleep(0.25)
-
-    if not os.path.exists(path) or os.path.getsize(path) < 1500:
-        return jsonify({'image': None})
-
-    filename = os.path.basename(path)
-    # Frontend tự ghép IP, ở đây trả full url local cũng được
-    url = f"http://127.0.0.1:5000/data/{filename}"
-    return jsonify({'image': url})
+    # Ảnh trong chỉ mục luôn đã ghi xong (ghi file tạm + đổi tên), không cần chờ kích thước file.
+    # ?since=V&wait=N: long-poll tới N giây (<= 30) cho tới khi có ảnh mới hơn version V
+    since = request.args.get('since', type=int)
+    wait = min(request.args.get('wait', default=0, type=float), 30)
+    if since is not None and wait > 0:
+        path, version = image_index.wait_newer(since, wait)
+    else:
+        path, version = image_index.get()
+    return jsonify({'image': image_url_for(path) if path else None, 'version': version})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    # ?wait=N: long-poll, giữ kết nối tối đa N giây (<= 30) cho tới khi job xong
+    # ?since=K: client đã nhận K ảnh, trả về ngay khi có ảnh thứ K+1 (job nhiều ảnh)
+    wait = min(request.args.get('wait', default=0, type=float), 30)
+    since = request.args.get('since', default=0, type=int)
+    job = image_jobs.get(job_id, wait=wait, since=since)
+    if job is None:
+        return jsonify({'error': 'Không tìm thấy job'}), 404
+    path = job.pop('path')
+    job['url'] = image_url_for(path) if path else None
+    job['urls'] = [image_url_for(p) for p in job.pop('paths')]
+    return jsonify(job)
+
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs_stats():
+    return jsonify(image_jobs.stats())
 
 # ====================================================
 # API LẤY LỊCH SỬ CHAT (ĐÃ SỬA: ĐỌC TỪ FIREBASE)
@@ -426,6 +599,37 @@ def api_weather_data():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+WEATHER_BATCH_MAX = 20
+
+@app.route('/api/weather_batch', methods=['GET', 'POST'])
+def api_weather_batch():
+    # Nhiều thành phố trong 1 request: POST {"cities": [...], "stream": true}
+    # hoặc GET ?city=Hà Nội&city=Huế&stream=1
+    try:
+        if request.method == 'POST':
+            data = request.json or {}
+            cities = data.get('cities') or []
+            stream = bool(data.get('stream'))
+        else:
+            cities = request.args.getlist('city')
+            stream = request.args.get('stream') in ('1', 'true')
+        if not isinstance(cities, list) or not cities:
+            return jsonify({'error': 'Thiếu danh sách thành phố'}), 400
+        cities = [str(c) for c in cities[:WEATHER_BATCH_MAX]]
+
+        if stream:
+            def generate():
+                for index, city, result in GetWeatherBatch(cities):
+                    yield json.dumps({'index': index, 'query': city, 'data': result}) + "\n"
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        results = [None] * len(cities)
+        for index, _, result in GetWeatherBatch(cities):
+            results[index] = result
+        return jsonify({'results': results})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # ====================================================
 # API REMINDERS
 # ====================================================
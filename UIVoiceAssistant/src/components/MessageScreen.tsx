@@ -281,6 +281,49 @@ export function MessageScreen({ onNavigate, user }: MessageScreenProps) {
     };
   }, []);
 
+  // ========================
+  // 3b. CHỜ JOB TẠO ẢNH (long-poll /api/jobs/<id>)
+  // ========================
+  const waitForImageJob = async (jobId: string, loadingId: string) => {
+    // Job nhiều ảnh: mỗi ảnh xong hiện ngay (ảnh đầu thay bong bóng chờ, ảnh sau thêm bong bóng mới)
+    let shown = 0;
+    try {
+      while (true) {
+        const res = await fetch(`${API_BASE}/api/jobs/${jobId}?wait=25&since=${shown}`);
+        const job = await res.json();
+        if (!res.ok) {
+          throw new Error(job.error || "Không tạo được ảnh.");
+        }
+        const urls: string[] = job.urls || [];
+        const fresh = urls.slice(shown);
+        if (fresh.length) {
+          const first = shown === 0 ? fresh.shift() : undefined;
+          setMessages(prev => [
+            ...prev.map(m =>
+              first && m.id === loadingId
+                ? { ...m, type: "ai-image", imageUrl: first, time: getTime() }
+                : m
+            ),
+            ...fresh.map((url): MessageType => ({ id: crypto.randomUUID(), type: "ai-image", imageUrl: url, time: getTime() })),
+          ]);
+          shown = urls.length;
+        }
+        if (job.status === "error" && shown === 0) {
+          throw new Error(job.error || "Không tạo được ảnh.");
+        }
+        if (job.status === "done" || job.status === "error") return;
+      }
+    } catch (e: any) {
+      setMessages(prev =>
+        prev.map(m =>
+          m.id === loadingId
+            ? { id: loadingId, type: "ai-static", content: `Lỗi tạo ảnh: ${e.message || e}`, time: getTime() }
+            : m
+        )
+      );
+    }
+  };
+
   // ========================
   // 4. SEND TEXT (GIỮ NGUYÊN)
   // ========================
@@ -309,7 +352,8 @@ export function MessageScreen({ onNavigate, user }: MessageScreenProps) {
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           text: textToSend,
-          uid: user.uid
+          uid: user.uid,
+          stream: true
         })
       });
 
@@ -318,6 +362,8 @@ export function MessageScreen({ onNavigate, user }: MessageScreenProps) {
       const reader = res.body.getReader();
       const decoder = new TextDecoder();
       let buffer = '';
+      // index task -> id bubble đang stream (chat-delta)
+      const streamingIds: Record<number, string> = {};
 
       while (true) {
         const { done, value } = await reader.read();
@@ -333,21 +379,55 @@ export function MessageScreen({ onNavigate, user }: MessageScreenProps) {
           try {
             const r = JSON.parse(line);
 
-            if (r.type === "chat") {
+            if (r.type === "chat-delta") {
+              const key = r.index ?? 0;
+              const streamId = streamingIds[key];
+              if (streamId) {
+                setMessages(prev =>
+                  prev.map(m =>
+                    m.id === streamId && m.type === "ai-streaming"
+                      ? { ...m, content: m.content + r.content }
+                      : m
+                  )
+                );
+              } else {
+                const newId = crypto.randomUUID();
+                streamingIds[key] = newId;
+                setMessages(prev => [
+                  ...prev,
+                  { id: newId, type: "ai-streaming", content: r.content, time: getTime() }
+                ]);
+              }
+            }
+            else if (r.type === "chat") {
               const cleanText = sanitize(r.content);
               speak(cleanText);
-              setMessages(prev => [
-                ...prev,
-                { id: crypto.randomUUID(), type: "ai-static", content: cleanText, time: getTime() }
-              ]);
+              const streamId = streamingIds[r.index ?? 0];
+              if (streamId) {
+                delete streamingIds[r.index ?? 0];
+                setMessages(prev =>
+                  prev.map(m =>
+                    m.id === streamId
+                      ? { id: streamId, type: "ai-static", content: cleanText, time: getTime() }
+                      : m
+                  )
+                );
+              } else {
+                setMessages(prev => [
+                  ...prev,
+                  { id: crypto.randomUUID(), type: "ai-static", content: cleanText, time: getTime() }
+                ]);
+              }
             }
             else if (r.type === "image-start") {
               const loadingId = crypto.randomUUID();
-              imageLoadingRef.current = loadingId;
               setMessages(prev => [
                 ...prev,
                 { id: loadingId, type: "ai-image-loading", time: getTime() }
               ]);
+              // Ảnh sinh nền: không giữ stream /api/process, tự hỏi trạng thái job
+              if (r.job_id) waitForImageJob(r.job_id, loadingId);
+              else imageLoadingRef.current = loadingId;
             }
             else if (r.type === "image") {
               if (imageLoadingRef.current) {